@@ -0,0 +1,279 @@
+"""
+Benchmarks the DeadSimpleDB hot paths: write modes, stypes, small and
+large values, hot key appends, multipart lists, list and delete.
+
+For write cases it reports the mean and p99 latency of the call itself
+(the enqueue latency with the write thread) and the time until everything
+is on disk (time to durable, measured until flush_all returns).
+
+    python benchmarks/bench_db.py [--quick] [--filter NAME] [--repeat N]
+                                  [--json results.json]
+                                  [--compare baseline.json] [--threshold 1.25]
+
+With --compare the results are checked against an earlier --json run and
+the script exits with status 1 if a case got slower than threshold times
+the baseline, so it can guard against regressions.
+
+Requires deadsimpledb to be importable, eg. pip install -e .
+"""
+import argparse
+import json
+import random
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from deadsimpledb import DeadSimpleDB
+
+ROOT = "/tmp/bench_db"
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def small_value(i):
+    return {'id': i, 'loss': random.Random(i).random(), 'tags': ['train', 'v1']}
+
+
+def large_value(i):
+    rng = random.Random(i)
+    return {'id': i, 'history': [{'step': s, 'loss': rng.random(), 'acc': rng.random()}
+                                 for s in range(2000)]}
+
+
+def timed_calls(calls):
+    """Runs the calls and returns the sorted latency of each."""
+    latencies = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies
+
+
+def result(latencies, durable=None):
+    count = len(latencies)
+    return {
+        'ops': count,
+        'mean_ms': 1000 * sum(latencies) / count,
+        'p99_ms': 1000 * latencies[min(count - 1, count * 99 // 100)],
+        'durable_s': durable if durable is not None else sum(latencies)}
+
+
+def write_case(db_kwargs, make_value, count, stype="json"):
+    db = DeadSimpleDB(ROOT, overwrite=True, **db_kwargs)
+    values = [make_value(i) for i in range(count)]
+    start = time.perf_counter()
+    latencies = timed_calls(
+        [lambda i=i: db.save(("bench", i), value=values[i], stype=stype) for i in range(count)])
+    db.flush_all()
+    durable = time.perf_counter() - start
+    db.close()
+    return result(latencies, durable)
+
+
+def make_db(count, **kwargs):
+    db = DeadSimpleDB(ROOT, overwrite=True, **kwargs)
+    db.save_many([(("bench", i), small_value(i)) for i in range(count)])
+    db.flush_all()
+    return db
+
+
+def register_write_modes():
+    modes = {
+        'mem_only': {'read_only': True, 'use_write_thread': False},
+        'with_thread': {},
+        'sync': {'use_write_thread': False},
+        'packed': {'storage': 'packed'},
+    }
+    for mode, kwargs in modes.items():
+        benchmark("write.{}.small".format(mode))(
+            lambda n, kwargs=kwargs: write_case(kwargs, small_value, n))
+        benchmark("write.{}.large".format(mode))(
+            lambda n, kwargs=kwargs: write_case(kwargs, large_value, max(1, n // 100)))
+
+
+def register_stypes():
+    cases = {
+        'json': (large_value, {}),
+        'json.orjson': (large_value, {'json_backend': 'orjson'}),
+        'pkl': (large_value, {}),
+        'msgpack': (large_value, {}),
+        'json.zst': (large_value, {'json_backend': 'orjson'}),
+        'npy': (lambda i: np.random.RandomState(i).rand(256, 256), {}),
+    }
+    for case, (make_value, kwargs) in cases.items():
+        stype = case.replace(".orjson", "")
+        benchmark("stype.{}".format(case))(
+            lambda n, make_value=make_value, kwargs=kwargs, stype=stype:
+                write_case(kwargs, make_value, max(1, n // 100), stype=stype))
+
+
+register_write_modes()
+register_stypes()
+
+
+@benchmark("append.hot_key_list")
+def bench_hot_key_list(n):
+    db = DeadSimpleDB(ROOT, overwrite=True)
+    count = max(1, n // 10)
+    start = time.perf_counter()
+    latencies = timed_calls([lambda i=i: db.append_to_list("hot", small_value(i)) for i in range(count)])
+    db.flush_all()
+    durable = time.perf_counter() - start
+    db.close()
+    return result(latencies, durable)
+
+
+@benchmark("append.multipart")
+def bench_multipart_append(n):
+    db = DeadSimpleDB(ROOT, overwrite=True, multipart_segment_bytes=64 * 1024)
+    start = time.perf_counter()
+    latencies = timed_calls(
+        [lambda i=i: db.append_to_multipart_list("hot", small_value(i)) for i in range(n)])
+    db.flush_all()
+    durable = time.perf_counter() - start
+    db.close()
+    return result(latencies, durable)
+
+
+@benchmark("read.multipart_iter")
+def bench_multipart_iter(n):
+    db = DeadSimpleDB(ROOT, overwrite=True, multipart_segment_bytes=64 * 1024)
+    for i in range(n):
+        db.append_to_multipart_list("hot", small_value(i))
+    latencies = timed_calls([lambda: list(db.iter_multipart_list("hot")),
+                             lambda: list(db.iter_multipart_list("hot", tail=100))])
+    db.close()
+    return result(latencies)
+
+
+@benchmark("read.get_cold")
+def bench_get_cold(n):
+    make_db(n).close()
+    db = DeadSimpleDB(ROOT, read_only=True)
+    latencies = timed_calls([lambda i=i: db.get(("bench", i)) for i in range(n)])
+    return result(latencies)
+
+
+@benchmark("read.get_many_cold")
+def bench_get_many_cold(n):
+    make_db(n).close()
+    db = DeadSimpleDB(ROOT, read_only=True)
+    latencies = timed_calls([lambda: db.get_many([(("bench", i), "data") for i in range(n)])])
+    db.close()
+    return result(latencies)
+
+
+@benchmark("list.scan")
+def bench_list_scan(n):
+    db = make_db(n)
+    latencies = timed_calls([lambda: db.list("bench", use_cache=False) for _ in range(5)])
+    db.close()
+    return result(latencies)
+
+
+@benchmark("list.indexed_page")
+def bench_list_page(n):
+    db = make_db(n)
+    db.list("bench")
+    latencies = timed_calls([lambda i=i: db.list_keys("bench", offset=i, limit=100)
+                             for i in range(0, n, max(1, n // 100))])
+    db.close()
+    return result(latencies)
+
+
+@benchmark("delete.single")
+def bench_delete_single(n):
+    db = make_db(n)
+    count = max(1, n // 10)
+    latencies = timed_calls([lambda i=i: db.delete(("bench", i)) for i in range(count)])
+    db.close()
+    return result(latencies)
+
+
+@benchmark("delete.many")
+def bench_delete_many(n):
+    db = make_db(n)
+    latencies = timed_calls([lambda: db.delete_many([(("bench", i), "data") for i in range(n)])])
+    db.close()
+    return result(latencies)
+
+
+@benchmark("delete.prefix")
+def bench_delete_prefix(n):
+    db = make_db(n)
+    latencies = timed_calls([lambda: db.delete_prefix("bench")])
+    db.close()
+    return result(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--quick", action="store_true", help="small sizes for a smoke run")
+    parser.add_argument("--filter", default=None, help="only run cases containing this")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest is kept")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    parser.add_argument("--compare", default=None, help="baseline results written with --json")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args()
+
+    size = 500 if args.quick else 5000
+    results = {}
+    print("{:26s} {:>8s} {:>10s} {:>10s} {:>10s}".format(
+        "case", "ops", "mean ms", "p99 ms", "durable s"))
+    for name, func in BENCHMARKS:
+        if args.filter and args.filter not in name:
+            continue
+        runs = []
+        for _ in range(args.repeat):
+            try:
+                runs.append(func(size))
+            except ImportError as e:
+                print("{:26s} skipped: {}".format(name, e))
+                break
+        if not runs:
+            continue
+        best = min(runs, key=lambda r: r['durable_s'])
+        results[name] = best
+        print("{:26s} {:8d} {:10.3f} {:10.3f} {:10.3f}".format(
+            name, best['ops'], best['mean_ms'], best['p99_ms'], best['durable_s']))
+    shutil.rmtree(ROOT, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'size': size, 'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['size'] != size:
+            print("baseline was run with size {}, not comparable".format(baseline['size']))
+            sys.exit(2)
+        regressions = []
+        for name, current in results.items():
+            old = baseline['results'].get(name)
+            if old is None:
+                continue
+            for metric in ('mean_ms', 'durable_s'):
+                if old[metric] > 0 and current[metric] > old[metric] * args.threshold:
+                    regressions.append("{} {}: {:.3f} -> {:.3f}".format(
+                        name, metric, old[metric], current[metric]))
+        if regressions:
+            print("Regressions:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regressions against {}".format(args.compare))
+
+
+if __name__ == "__main__":
+    main()
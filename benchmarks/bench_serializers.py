@@ -0,0 +1,80 @@
+"""
+Compares encode/decode throughput and encoded size of the registered
+serializers on a typical experiment record.
+
+    python benchmarks/bench_serializers.py [iterations]
+
+Requires deadsimpledb to be importable, eg. pip install -e .
+"""
+import random
+import sys
+import time
+
+from deadsimpledb.deadsimpledb import (JSONDecoderDefault, JSONEncoderDefault,
+                                       get_serializer)
+
+
+def make_record(i):
+    rng = random.Random(i)
+    return {
+        'id': i,
+        'name': "experiment_{}".format(i),
+        'status': rng.choice(['running', 'done', 'failed']),
+        'params': {'lr': rng.random() / 100, 'batch_size': 64, 'layers': [128, 64, 32]},
+        'metrics': {'loss': [rng.random() for _ in range(50)],
+                    'accuracy': [rng.random() for _ in range(50)]},
+        'tags': ['baseline', 'gpu', 'v{}'.format(i % 7)],
+    }
+
+
+def bench(stype, options, records, iterations):
+    serializer = get_serializer(stype)
+    try:
+        encoded = [serializer.dumps(r, options) for r in records]
+    except ImportError as e:
+        return None, str(e)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for r in records:
+            serializer.dumps(r, options)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for data in encoded:
+            serializer.loads(data, options)
+    decode_time = time.perf_counter() - start
+    count = iterations * len(records)
+    size = sum(len(d) for d in encoded) / len(encoded)
+    return (count / encode_time, count / decode_time, size), None
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    records = [make_record(i) for i in range(200)]
+    cases = [
+        ('json', 'simplejson'),
+        ('json', 'orjson'),
+        ('msgpack', None),
+        ('pkl', None),
+        ('json.zst', 'orjson'),
+        ('json.lz4', 'orjson'),
+        ('msgpack.zst', None),
+        ('msgpack.lz4', None),
+    ]
+    print("{:14s} {:11s} {:>12s} {:>12s} {:>10s}".format(
+        "stype", "json", "encode/s", "decode/s", "bytes"))
+    for stype, backend in cases:
+        options = {'json_encoder': JSONEncoderDefault,
+                   'json_decoder': JSONDecoderDefault,
+                   'json_backend': backend}
+        result, error = bench(stype, options, records, iterations)
+        if error:
+            print("{:14s} {:11s} skipped: {}".format(stype, backend or "", error))
+            continue
+        encode_rate, decode_rate, size = result
+        print("{:14s} {:11s} {:12.0f} {:12.0f} {:10.0f}".format(
+            stype, backend or "", encode_rate, decode_rate, size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Compares the snapshot modes of the write queue on large nested dicts:
+the latency save adds on the caller thread and the time until the value
+is on disk.
+
+    python benchmarks/bench_snapshot.py [entries] [records_per_entry]
+
+Requires deadsimpledb to be importable, eg. pip install -e .
+"""
+import random
+import sys
+import time
+
+from deadsimpledb import DeadSimpleDB
+
+
+def make_value(records):
+    rng = random.Random(records)
+    return {
+        'config': {'lr': 0.001, 'layers': [128, 64, 32], 'name': "run"},
+        'history': [{'step': i,
+                     'loss': rng.random(),
+                     'metrics': {'accuracy': rng.random(), 'f1': rng.random()},
+                     'tags': ['train', 'epoch_{}'.format(i // 100)]}
+                    for i in range(records)],
+    }
+
+
+def bench(snapshot, entries, records):
+    db = DeadSimpleDB("/tmp/bench_snapshot_{}".format(snapshot), overwrite=True,
+                      snapshot=snapshot, max_write_latency=0.05)
+    values = [make_value(records) for _ in range(entries)]
+    latencies = []
+    start = time.perf_counter()
+    for i, value in enumerate(values):
+        t = time.perf_counter()
+        db.save(("bench", i), value=value)
+        latencies.append(time.perf_counter() - t)
+    db.flush_all()
+    durable = time.perf_counter() - start
+    db.close()
+    latencies.sort()
+    return (sum(latencies) / len(latencies), latencies[len(latencies) * 99 // 100], durable)
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    records = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    print("{} entries of {} records".format(entries, records))
+    print("{:10s} {:>14s} {:>14s} {:>14s}".format(
+        "snapshot", "save mean ms", "save p99 ms", "to disk s"))
+    for snapshot in ["none", "copy", "deepcopy", "serialize"]:
+        mean, p99, durable = bench(snapshot, entries, records)
+        print("{:10s} {:14.3f} {:14.3f} {:14.2f}".format(
+            snapshot, mean * 1000, p99 * 1000, durable))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Times what a short lived process pays before doing any work: importing
+deadsimpledb, constructing a DeadSimpleDB and reading a single json entry.
+Every run is a fresh interpreter, the median over the runs is reported
+along with the heavy modules that ended up imported.
+
+    python benchmarks/bench_startup.py [--runs N] [--path CHECKOUT ...]
+
+By default deadsimpledb is imported from the checkout this script is in.
+--path imports it from other checkouts instead (eg. a git worktree of an
+older commit) to compare against, it can be given more than once.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+ROOT = "/tmp/bench_startup"
+CHECKOUT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["numpy", "PIL", "simplejson", "asyncio", "multiprocessing"]
+
+CHILD = """
+import json, sys, time, threading
+start = time.perf_counter()
+import deadsimpledb
+imported = time.perf_counter()
+db = deadsimpledb.DeadSimpleDB({root!r}, read_only=True)
+constructed = time.perf_counter()
+db.get("entry")
+done = time.perf_counter()
+print(json.dumps({{
+    'import_ms': 1000 * (imported - start),
+    'construct_ms': 1000 * (constructed - imported),
+    'read_ms': 1000 * (done - constructed),
+    'total_ms': 1000 * (done - start),
+    'threads': threading.active_count(),
+    'modules': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def run_child(path):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.abspath(path)
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(root=ROOT, heavy=HEAVY_MODULES)],
+        env=env, cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    # older versions print from the writer thread, keep only the result
+    return json.loads([line for line in output.splitlines() if line.startswith("{")][0])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--path", action="append", default=None,
+                        help="checkout to import deadsimpledb from")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(ROOT, "entry"), exist_ok=True)
+    with open(os.path.join(ROOT, "entry", "data.json"), "w") as f:
+        json.dump({'config': {'lr': 0.001}, 'steps': list(range(100))}, f)
+
+    print("{:30s} {:>10s} {:>12s} {:>8s} {:>9s} {:>8s}  {}".format(
+        "deadsimpledb from", "import ms", "construct ms", "read ms", "total ms", "threads", "modules"))
+    for path in args.path or [CHECKOUT]:
+        # the first run compiles the byte code, it is not counted
+        run_child(path)
+        runs = [run_child(path) for _ in range(args.runs)]
+        print("{:30s} {:10.1f} {:12.2f} {:8.2f} {:9.1f} {:8d}  {}".format(
+            path,
+            median([r['import_ms'] for r in runs]),
+            median([r['construct_ms'] for r in runs]),
+            median([r['read_ms'] for r in runs]),
+            median([r['total_ms'] for r in runs]),
+            runs[-1]['threads'],
+            ",".join(runs[-1]['modules'])))
+    shutil.rmtree(ROOT, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1 @@
-from .deadsimpledb import DeadSimpleDB, format_key
\ No newline at end of file
+from .deadsimpledb import DeadSimpleDB, AsyncDeadSimpleDB, format_key
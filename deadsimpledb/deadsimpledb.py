@@ -6,44 +6,96 @@ import shutil
 import time
 from typing import Any, Dict, List, Tuple
 import copy
-import numpy as np
-import PIL.Image
-import simplejson as json
 from os.path import isfile, join
 import threading
-from multiprocessing import Process
-# from multiprocessing import SimpleQueue as Queue
-from multiprocessing import Queue
-# from queue import SimpleQueue as Queue
-SUPPORTED_FILE_TYPES = ['png', 'jpg', 'pkl', 'json', 'csv']
-
-class JSONEncoderDefault(json.JSONEncoder):
-
-    def default(self, obj):  # pylint: disable=E0202
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            if obj.size() > 1000:
-                return "REDACTED: NUMPY OBJ OF SIZE {} TOO LARGE".format(obj.size())
+import functools
+import itertools
+import atexit
+import weakref
+import sys
+import stat
+import io
+import bisect
+import sqlite3
+import zlib
+import contextlib
+import concurrent.futures
+from collections import OrderedDict
+# numpy, PIL, simplejson, asyncio and the multiprocessing behind
+# concurrent.futures.ProcessPoolExecutor are imported where they are first
+# needed, importing them takes most of the startup time of short lived
+# processes that only read an entry or two.
+
+# registered stypes in order of precedence and the ones of them probed for
+# when an entry is read without stype, filled by register_serializer
+SUPPORTED_FILE_TYPES = []
+PROBED_FILE_TYPES = []
+
+def loaded_numpy():
+    """
+    Returns numpy if something imported it, None otherwise. A value can
+    only be a numpy object once numpy is imported, so type checks don't
+    need to import it.
+    """
+    return sys.modules.get('numpy')
+
+def is_ndarray(value):
+    np = loaded_numpy()
+    return np is not None and type(value) is np.ndarray
+
+def _define_json_classes():
+    """
+    Defines JSONEncoderDefault and JSONDecoderDefault on first use, they
+    subclass the simplejson classes.
+    """
+    import simplejson as json
+
+    class JSONEncoderDefault(json.JSONEncoder):
+
+        def default(self, obj):  # pylint: disable=E0202
+            np = loaded_numpy()
+            if np is not None and isinstance(obj, np.integer):
+                return int(obj)
+            elif np is not None and isinstance(obj, np.floating):
+                return float(obj)
+            elif np is not None and isinstance(obj, np.ndarray):
+                if obj.size > 1000:
+                    return "REDACTED: NUMPY OBJ OF SIZE {} TOO LARGE".format(obj.size)
+                else:
+                    return obj.tolist()
             else:
-                return obj.tolist()
-        else:
-            try:
-                return super(JSONEncoderDefault, self).default(obj)
-            except Exception as e:
-                return "ENCODE_FAILED:{}_AS_STR:{}".format(type(obj),obj)
+                try:
+                    return super(JSONEncoderDefault, self).default(obj)
+                except Exception as e:
+                    return "ENCODE_FAILED:{}_AS_STR:{}".format(type(obj),obj)
+
 
+    class JSONDecoderDefault(json.JSONDecoder):
 
-class JSONDecoderDefault(json.JSONDecoder):
+        def __init__(self, *args, **kwargs):
+            json.JSONDecoder.__init__(
+                self, object_hook=self.object_hook, *args, **kwargs)
 
-    def __init__(self, *args, **kwargs):
-        json.JSONDecoder.__init__(
-            self, object_hook=self.object_hook, *args, **kwargs)
+        def object_hook(self, obj):  # pylint: disable=E0202
+            return obj
 
-    def object_hook(self, obj):  # pylint: disable=E0202
-        return obj
+    # module level names so they can be pickled and imported as before
+    for cls in (JSONEncoderDefault, JSONDecoderDefault):
+        cls.__qualname__ = cls.__name__
+        globals()[cls.__name__] = cls
+    return json
+
+def __getattr__(name):
+    if name in ('JSONEncoderDefault', 'JSONDecoderDefault'):
+        _define_json_classes()
+        return globals()[name]
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+def get_json():
+    """Returns simplejson, defining the default encoder and decoder on first use."""
+    if 'JSONDecoderDefault' not in globals():
+        return _define_json_classes()
+    return sys.modules['simplejson']
 
 def format_key(key):
     if type(key) is str:
@@ -51,8 +103,19 @@ def format_key(key):
     else:
         return tuple([str(k) for k in key])
 
+def split_stype(filename):
+    """
+    Splits a file name into name and stype. Registered stypes may contain
+    a dot (eg. json.zst).
+    """
+    for stype in _STYPES_LONGEST_FIRST:
+        if filename.endswith("." + stype) and len(filename) > len(stype) + 1:
+            return filename[:-len(stype) - 1], stype
+    name, stype = os.path.splitext(filename)
+    return name, stype[1:]
+
 def get_filetype(filepath_prefix):
-    for ft in SUPPORTED_FILE_TYPES:
+    for ft in PROBED_FILE_TYPES:
         if os.path.exists(filepath_prefix + "." + ft):
             return ft
     return None
@@ -64,12 +127,1588 @@ def path_to_key_name_stype(root_path, full_file_path, sep="/"):
         full_file_path = full_file_path.replace(root_path,"",1)
     if full_file_path.startswith(sep):
         full_file_path=full_file_path[1:]
-    fpath, stype = os.path.splitext(full_file_path)
-    path_parts = fpath.split(sep)
-    name = path_parts[-1]
+    path_parts = full_file_path.split(sep)
+    name, stype = split_stype(path_parts[-1])
     path_parts = path_parts[:-1]
     key = format_key(path_parts)
-    return key, name, stype[1:]
+    return key, name, stype
+
+class Serializer:
+    """
+    Converts the values of one storage type (stype) to and from the bytes
+    stored on disk. options holds the settings of the database, eg. the json
+    encoder and decoder classes.
+    """
+    # encoding is CPU heavy and worth running in a process pool
+    cpu_bound = False
+
+    def dumps(self, value, options) -> bytes:
+        raise NotImplementedError()
+
+    def loads(self, data: bytes, options):
+        raise Exception("Unsupported format")
+
+    def load(self, filepath, options, mmap=False):
+        with open(filepath, 'rb') as f:
+            return self.loads(f.read(), options)
+
+
+class JSONSerializer(Serializer):
+    """
+    json through simplejson, or orjson with options['json_backend'] set to
+    'orjson'. orjson falls back to simplejson for values it can not handle
+    (eg. integers above 64 bit) and decoding only uses orjson with the
+    default decoder. An encoder or decoder of None means the default one,
+    simplejson is only imported once it is needed.
+    """
+
+    def encoder(self, options):
+        return options['json_encoder'] or getattr(sys.modules[__name__], 'JSONEncoderDefault')
+
+    def decoder(self, options):
+        return options['json_decoder'] or getattr(sys.modules[__name__], 'JSONDecoderDefault')
+
+    def dumps(self, value, options):
+        if options.get('json_backend') == 'orjson':
+            import orjson
+            try:
+                return orjson.dumps(value,
+                    default=lambda obj: self.encoder(options)().default(obj),
+                    option=orjson.OPT_NON_STR_KEYS)
+            except orjson.JSONEncodeError:
+                pass
+        json = get_json()
+        return json.dumps(value, ignore_nan=True, cls=self.encoder(options)).encode('utf-8')
+
+    def loads(self, data, options):
+        if (options.get('json_backend') == 'orjson'
+                and options['json_decoder'] in (None, globals().get('JSONDecoderDefault'))):
+            import orjson
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+        if type(data) is not str:
+            data = data.decode('utf-8')
+        json = get_json()
+        return json.loads(data, cls=self.decoder(options))
+
+
+class JSONLinesSerializer(Serializer):
+    """A list stored as one json document per line."""
+
+    def dumps(self, value, options):
+        return b"".join(JSON_SERIALIZER.dumps(v, options) + b"\n" for v in value)
+
+    def loads(self, data, options):
+        return [JSON_SERIALIZER.loads(line, options) for line in data.splitlines() if line.strip()]
+
+
+class PickleSerializer(Serializer):
+    cpu_bound = True
+
+    def dumps(self, value, options):
+        return pickle.dumps(value)
+
+    def loads(self, data, options):
+        return pickle.loads(data)
+
+
+class LazyImage:
+    """
+    An image read from the database. It holds the encoded bytes as read,
+    so later writes of the entry don't change it, and only decodes what is
+    needed: size, mode and shape come from the header, np.asarray(image) or
+    to_array() decode the pixels.
+    """
+
+    def __init__(self, source):
+        # the encoded bytes
+        self.source = source
+        self._size = None
+        self._mode = None
+        self._array = None
+
+    @property
+    def nbytes(self):
+        """Memory held, the encoded bytes and the decoded array once decoded."""
+        return len(self.source) + (self._array.nbytes if self._array is not None else 0)
+
+    def open(self):
+        """Returns the image opened with PIL, it is decoded on first access to its pixels."""
+        import PIL.Image
+        return PIL.Image.open(io.BytesIO(self.source))
+
+    def _read_header(self):
+        if self._size is None:
+            with self.open() as im:
+                self._size = im.size
+                self._mode = im.mode
+
+    @property
+    def size(self):
+        """(width, height) like PIL"""
+        self._read_header()
+        return self._size
+
+    @property
+    def mode(self):
+        self._read_header()
+        return self._mode
+
+    @property
+    def shape(self):
+        """Shape of the decoded array, (height, width) or (height, width, bands)"""
+        self._read_header()
+        width, height = self._size
+        import PIL.Image
+        bands = PIL.Image.getmodebands(self._mode)
+        return (height, width) if bands == 1 else (height, width, bands)
+
+    def to_array(self, draft_size=None):
+        """
+        Decodes the image into a numpy array. draft_size=(width, height) lets
+        JPEG decode directly at a reduced scale of at least that size, which
+        is much faster than decoding the full image. The full size array is
+        kept once decoded.
+        """
+        if draft_size is None and self._array is not None:
+            return self._array
+        import numpy as np
+        with self.open() as im:
+            if draft_size is not None:
+                im.draft(im.mode, draft_size)
+            array = np.asarray(im)
+        if draft_size is None:
+            self._array = array
+        return array
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_array()
+        return array if dtype is None else array.astype(dtype)
+
+    def __repr__(self):
+        return "LazyImage(size={}, mode={})".format(self.size, self.mode)
+
+
+class ImageSerializer(Serializer):
+    """
+    png and jpg through PIL. Reads return a LazyImage. options
+    'png_compress_level' (0-9, PIL defaults to 6) and 'jpg_quality' (1-95,
+    PIL defaults to 75) trade encoding time for size.
+    """
+    cpu_bound = True
+
+    def __init__(self, image_format):
+        self.image_format = image_format
+
+    def dumps(self, value, options):
+        import PIL.Image
+        if is_ndarray(value):
+            im = PIL.Image.fromarray(value)
+        elif isinstance(value, LazyImage):
+            im = value.open()
+        else:
+            im = value
+        params = {}
+        if self.image_format == "PNG" and options.get('png_compress_level') is not None:
+            params['compress_level'] = options['png_compress_level']
+        if self.image_format == "JPEG" and options.get('jpg_quality') is not None:
+            params['quality'] = options['jpg_quality']
+        f = io.BytesIO()
+        im.save(f, format=self.image_format, **params)
+        return f.getvalue()
+
+    def loads(self, data, options):
+        return LazyImage(bytes(data))
+
+    def load(self, filepath, options, mmap=False):
+        with open(filepath, 'rb') as f:
+            return LazyImage(f.read())
+
+
+class CSVSerializer(Serializer):
+    """Rows stored tab separated."""
+    quotechar = '|'
+
+    def dumps(self, value, options):
+        f = io.StringIO()
+        writer = csv.writer(f, delimiter='\t',
+                                quotechar=self.quotechar,
+                                quoting=csv.QUOTE_MINIMAL)
+        writer.writerows(value)
+        return f.getvalue().encode('utf-8')
+
+    def loads(self, data, options):
+        return [line for line in self.reader(io.StringIO(data.decode('utf-8')))]
+
+    def reader(self, text_file):
+        return csv.reader(text_file, delimiter='\t', quotechar=self.quotechar)
+
+    def scan_rows(self, f, row, offset, step, checkpoints):
+        """
+        Counts the rows of the binary file f from offset, where row row
+        starts, without parsing the fields. Appends [row, offset] to
+        checkpoints for every row number divisible by step. Quoted fields
+        may span lines, a row ends at a line end outside of quotes (quotes
+        inside fields are doubled so the count stays even). Returns the
+        row and offset after the last complete row.
+        """
+        quote = self.quotechar.encode('utf-8')
+        quotes = 0
+        position = offset
+        for line in f:
+            position += len(line)
+            quotes += line.count(quote)
+            if quotes % 2 == 0 and line.endswith(b"\n"):
+                quotes = 0
+                row += 1
+                offset = position
+                if row % step == 0:
+                    checkpoints.append([row, offset])
+        return row, offset
+
+
+class NumpySerializer(Serializer):
+    """A single array in npy format, can be memory mapped when read."""
+
+    def dumps(self, value, options):
+        import numpy as np
+        f = io.BytesIO()
+        np.save(f, value, allow_pickle=False)
+        return f.getvalue()
+
+    def loads(self, data, options):
+        import numpy as np
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+    def load(self, filepath, options, mmap=False):
+        import numpy as np
+        return np.load(filepath, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+
+class NumpyArchiveSerializer(Serializer):
+    """A dict of arrays (or a single array) in npz format."""
+
+    def dumps(self, value, options):
+        import numpy as np
+        f = io.BytesIO()
+        if isinstance(value, dict):
+            np.savez(f, **value)
+        else:
+            np.savez(f, value)
+        return f.getvalue()
+
+    def loads(self, data, options):
+        return self.load(io.BytesIO(data), options)
+
+    def load(self, filepath, options, mmap=False):
+        import numpy as np
+        with np.load(filepath, allow_pickle=False) as f:
+            return {k: f[k] for k in f.files}
+
+
+def _msgpack_default(obj):
+    np = loaded_numpy()
+    if np is not None and isinstance(obj, np.integer):
+        return int(obj)
+    elif np is not None and isinstance(obj, np.floating):
+        return float(obj)
+    elif np is not None and isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, (tuple, set)):
+        return list(obj)
+    raise TypeError("Can not encode {} with msgpack".format(type(obj)))
+
+
+class MsgpackSerializer(Serializer):
+    """msgpack, requires the msgpack package."""
+
+    def dumps(self, value, options):
+        import msgpack
+        return msgpack.packb(value, use_bin_type=True, default=_msgpack_default)
+
+    def loads(self, data, options):
+        import msgpack
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+class CompressedSerializer(Serializer):
+    """
+    Compresses the output of another serializer with zstd (requires the
+    zstandard package) or lz4 (requires the lz4 package).
+    """
+    cpu_bound = True
+
+    def __init__(self, serializer, codec):
+        self.serializer = serializer
+        self.codec = codec
+        # zstd contexts are reused but can not be shared between threads
+        self.local = threading.local()
+
+    def dumps(self, value, options):
+        data = self.serializer.dumps(value, options)
+        if self.codec == "zst":
+            compressor = getattr(self.local, 'compressor', None)
+            if compressor is None:
+                import zstandard
+                compressor = self.local.compressor = zstandard.ZstdCompressor(level=3)
+            return compressor.compress(data)
+        else:
+            import lz4.frame
+            return lz4.frame.compress(data)
+
+    def loads(self, data, options):
+        if self.codec == "zst":
+            decompressor = getattr(self.local, 'decompressor', None)
+            if decompressor is None:
+                import zstandard
+                decompressor = self.local.decompressor = zstandard.ZstdDecompressor()
+            data = decompressor.decompress(data)
+        else:
+            import lz4.frame
+            data = lz4.frame.decompress(data)
+        return self.serializer.loads(data, options)
+
+
+SERIALIZERS: Dict[str, Serializer] = {}
+_STYPES_LONGEST_FIRST: List[str] = []
+
+def register_serializer(stype, serializer, probe=True):
+    """
+    Registers the serializer used to read and write files of stype, stype
+    is also the file extension. With probe=False entries of stype are only
+    found when listed or read with stype given, which keeps every read of
+    an entry of unknown type from checking for one more file.
+    """
+    if stype not in SERIALIZERS:
+        SUPPORTED_FILE_TYPES.append(stype)
+    if probe and stype not in PROBED_FILE_TYPES:
+        PROBED_FILE_TYPES.append(stype)
+    elif not probe and stype in PROBED_FILE_TYPES:
+        PROBED_FILE_TYPES.remove(stype)
+    SERIALIZERS[stype] = serializer
+    _STYPES_LONGEST_FIRST[:] = sorted(SUPPORTED_FILE_TYPES, key=len, reverse=True)
+
+def get_serializer(stype):
+    return SERIALIZERS.get(stype.lower())
+
+JSON_SERIALIZER = JSONSerializer()
+PICKLE_SERIALIZER = PickleSerializer()
+MSGPACK_SERIALIZER = MsgpackSerializer()
+
+register_serializer('png', ImageSerializer("PNG"))
+register_serializer('jpg', ImageSerializer("JPEG"))
+register_serializer('pkl', PICKLE_SERIALIZER)
+register_serializer('json', JSON_SERIALIZER)
+CSV_SERIALIZER = CSVSerializer()
+register_serializer('csv', CSV_SERIALIZER)
+register_serializer('jsonl', JSONLinesSerializer())
+register_serializer('npy', NumpySerializer())
+register_serializer('npz', NumpyArchiveSerializer())
+register_serializer('msgpack', MSGPACK_SERIALIZER)
+# register them again with probe=True to read them without stype
+for codec in ['zst', 'lz4']:
+    register_serializer('json.' + codec, CompressedSerializer(JSON_SERIALIZER, codec), probe=False)
+    register_serializer('msgpack.' + codec, CompressedSerializer(MSGPACK_SERIALIZER, codec), probe=False)
+    register_serializer('pkl.' + codec, CompressedSerializer(PICKLE_SERIALIZER, codec), probe=False)
+
+def encode_value(value, stype, options):
+    """
+    Serializes value to the bytes stored on disk for stype. This is a module
+    level function so it can be run in a process pool.
+    """
+    serializer = get_serializer(stype)
+    if serializer is not None:
+        return serializer.dumps(value, options)
+    elif type(value) is bytes:
+        return value
+    else:
+        return value.encode('utf-8')
+
+def fsync_dir(path):
+    """Makes renames in path durable, a no-op where directories can not be opened (Windows)."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# items of a container approx_size looks at, the rest is extrapolated
+_SIZE_SAMPLE = 16
+_SCALAR_TYPES = frozenset([int, float, bool, type(None)])
+
+def approx_size(value, budget=256):
+    """
+    Estimate of the in-memory size of a value in bytes, containers
+    included. Large containers are extrapolated from a sample of their
+    items and budget caps the number of values looked at, so the cost stays
+    bounded regardless of the value size. Encoded values (snapshot=
+    "serialize") and numpy arrays are measured exactly.
+    """
+    value_type = type(value)
+    if value_type is str or value_type is bytes:
+        return len(value)
+    if value_type in _SCALAR_TYPES:
+        return sys.getsizeof(value)
+    if value_type is dict:
+        count = len(value)
+        if count == 0 or budget <= 1:
+            return sys.getsizeof(value)
+        samples = min(count, _SIZE_SAMPLE)
+        child_budget = (budget - 1) // (2 * samples)
+        sampled = 0
+        for k, v in itertools.islice(value.items(), samples):
+            sampled += approx_size(k, child_budget) + approx_size(v, child_budget)
+        return sys.getsizeof(value) + sampled * count // samples
+    if value_type is list or value_type is tuple:
+        count = len(value)
+        if count == 0 or budget <= 1:
+            return sys.getsizeof(value)
+        sample = value[::max(1, count // _SIZE_SAMPLE)][:_SIZE_SAMPLE]
+        child_budget = (budget - 1) // len(sample)
+        sampled = 0
+        for item in sample:
+            sampled += approx_size(item, child_budget)
+        return sys.getsizeof(value) + sampled * count // len(sample)
+    if value_type is set or value_type is frozenset:
+        count = len(value)
+        if count == 0 or budget <= 1:
+            return sys.getsizeof(value)
+        sample = list(itertools.islice(value, _SIZE_SAMPLE))
+        child_budget = (budget - 1) // len(sample)
+        sampled = sum(approx_size(item, child_budget) for item in sample)
+        return sys.getsizeof(value) + sampled * count // len(sample)
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    return sys.getsizeof(value)
+
+# leaves snapshot_copy shares without a call
+_ATOMIC_TYPES = frozenset([str, int, float, bool, bytes, type(None)])
+
+def snapshot_copy(value):
+    """
+    Structural copy of a value: dicts, lists, sets and numpy arrays are
+    copied recursively, everything else is treated as immutable and shared.
+    Much cheaper than copy.deepcopy as there is no memo and no dispatch
+    through __deepcopy__/__reduce__.
+    """
+    value_type = type(value)
+    if value_type is dict:
+        return {k: v if type(v) in _ATOMIC_TYPES else snapshot_copy(v) for k, v in value.items()}
+    if value_type is list:
+        return [v if type(v) in _ATOMIC_TYPES else snapshot_copy(v) for v in value]
+    if is_ndarray(value):
+        return value.copy()
+    if value_type is set:
+        return set(value)
+    if value_type is tuple:
+        return tuple(snapshot_copy(v) for v in value)
+    return value
+
+
+class EncodedValue:
+    """A value already serialized on the caller thread, written as is."""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+
+class PendingWrite:
+    """
+    A queued write. seq is the sequence number of the oldest change not yet
+    written, it is kept when newer values replace the pending value.
+    """
+    __slots__ = ('value', 'stype', 'size', 'enqueued_at', 'version', 'seq')
+
+    def __init__(self, value, stype, size, enqueued_at, version, seq):
+        self.value = value
+        self.stype = stype
+        self.size = size
+        self.enqueued_at = enqueued_at
+        self.version = version
+        self.seq = seq
+
+
+class CoalescingWriteQueue:
+    """
+    Write-behind queue keyed by (key, name). A write to an entry which is
+    already pending replaces the pending value, so only the latest value of
+    an entry is written per flush. Pending writes are handed to the writer
+    once the oldest one has waited max_latency seconds, once max_dirty_bytes
+    is reached, or when a flush is requested.
+
+    Every put gets a sequence number. Waiting for a flush means waiting
+    until no pending or in flight write holds a change with a sequence
+    number at or below the one current when the flush was requested.
+
+    max_items and max_bytes bound the pending and in flight writes. A put
+    of a new entry into a full queue blocks until the writer made room with
+    overflow="block", with overflow="sync" put returns False and the caller
+    writes itself. Entries already queued are always accepted as they
+    replace their pending value.
+    """
+
+    def __init__(self, max_latency=1.0, max_dirty_bytes=64 * 1024 * 1024,
+                 max_items=None, max_bytes=None, overflow="block"):
+        self.max_latency = max_latency
+        self.max_dirty_bytes = max_dirty_bytes
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()
+        self.in_flight: Dict[Tuple, int] = {}
+        self.in_flight_sizes: Dict[Tuple, int] = {}
+        self.in_flight_bytes = 0
+        self.dirty_bytes = 0
+        self.blocked = 0
+        self.rejected = 0
+        self.seq = 0
+        self.waiters = 0
+        self.flush_requested = False
+        self.running = True
+
+    def _full(self, size):
+        if len(self.pending) + len(self.in_flight) == 0:
+            return False
+        if self.max_items is not None and len(self.pending) + len(self.in_flight) >= self.max_items:
+            return True
+        return (self.max_bytes is not None
+                and self.dirty_bytes + self.in_flight_bytes + size > self.max_bytes)
+
+    def put(self, item, version=None, size=None):
+        """
+        Queues a write. size is the approximate size of the value, measured
+        if not given. Returns False if the queue is full and overflow is
+        "sync", the caller has to write the value itself.
+        """
+        key, name, value, stype = item
+        if size is None:
+            size = approx_size(value)
+        with self.cond:
+            key_name = (key, name)
+            if (key_name not in self.pending and key_name not in self.in_flight
+                    and self._full(size)):
+                if self.overflow == "sync" and self.running:
+                    self.rejected += 1
+                    return False
+                self.blocked += 1
+                # write out what is queued instead of waiting for max_latency
+                self.flush_requested = True
+                self.cond.notify_all()
+                self.waiters += 1
+                try:
+                    self.cond.wait_for(lambda: not self.running or key_name in self.pending
+                                       or not self._full(size))
+                finally:
+                    self.waiters -= 1
+            self.seq += 1
+            old = self.pending.get((key, name))
+            if old is None:
+                self.pending[(key, name)] = PendingWrite(
+                    value, stype, size, time.time(), version, self.seq)
+            else:
+                # keep the original enqueue time and seq so max_latency and flushes still hold
+                self.dirty_bytes -= old.size
+                old.value = value
+                old.stype = stype
+                old.size = size
+                old.version = version
+            self.dirty_bytes += size
+            if len(self.pending) == 1 or self.dirty_bytes >= self.max_dirty_bytes:
+                self.cond.notify_all()
+            return True
+
+    def get_batch(self):
+        """
+        Blocks until pending writes are due and returns them as a list of
+        ((key, name), PendingWrite). Returns None once the queue is closed
+        and empty. The writer calls done() for each write of the batch.
+        """
+        with self.cond:
+            while True:
+                if self.pending:
+                    if (not self.running or self.flush_requested
+                            or self.dirty_bytes >= self.max_dirty_bytes):
+                        break
+                    oldest = next(iter(self.pending.values())).enqueued_at
+                    timeout = oldest + self.max_latency - time.time()
+                    if timeout <= 0:
+                        break
+                elif not self.running:
+                    return None
+                else:
+                    timeout = None
+                self.cond.wait(timeout)
+            batch = list(self.pending.items())
+            self.pending = OrderedDict()
+            self.dirty_bytes = 0
+            self.flush_requested = False
+            for key_name, pending in batch:
+                self.in_flight[key_name] = pending.seq
+                self.in_flight_sizes[key_name] = pending.size
+                self.in_flight_bytes += pending.size
+            return batch
+
+    def done(self, key, name):
+        with self.cond:
+            self.in_flight.pop((key, name), None)
+            self.in_flight_bytes -= self.in_flight_sizes.pop((key, name), 0)
+            if self.waiters:
+                self.cond.notify_all()
+
+    def request_flush(self):
+        """
+        Asks for all pending writes to be handed to the writer now and
+        returns the sequence number to pass to wait().
+        """
+        with self.cond:
+            if self.pending:
+                self.flush_requested = True
+                self.cond.notify_all()
+            return self.seq
+
+    def _is_written(self, seq, key_name=None):
+        if key_name is not None:
+            pending = self.pending.get(key_name)
+            in_flight = self.in_flight.get(key_name)
+            return ((pending is None or pending.seq > seq)
+                    and (in_flight is None or in_flight > seq))
+        # both are in insertion order and a pending write keeps its first seq,
+        # so the first item of each holds the lowest seq
+        if self.pending and next(iter(self.pending.values())).seq <= seq:
+            return False
+        if self.in_flight and next(iter(self.in_flight.values())) <= seq:
+            return False
+        return True
+
+    def wait(self, seq, key_name=None, timeout=None):
+        """
+        Blocks until every change up to seq, or only those of key_name, is
+        written. Returns False if the timeout expired first.
+        """
+        with self.cond:
+            self.waiters += 1
+            try:
+                return self.cond.wait_for(lambda: self._is_written(seq, key_name), timeout)
+            finally:
+                self.waiters -= 1
+
+    def flush(self, timeout=None):
+        return self.wait(self.request_flush(), timeout=timeout)
+
+    def flush_entry(self, key, name, timeout=None):
+        return self.wait(self.request_flush(), (key, name), timeout=timeout)
+
+    def cancel(self, match, timeout=None):
+        """
+        Drops the pending writes of the entries for which match(key, name)
+        is true and waits until those already handed to the writer are
+        done. Returns False if the timeout expired first.
+        """
+        with self.cond:
+            for key_name in [key_name for key_name in self.pending if match(*key_name)]:
+                self.dirty_bytes -= self.pending.pop(key_name).size
+            # flushes may have been waiting on the dropped writes
+            self.cond.notify_all()
+            self.waiters += 1
+            try:
+                return self.cond.wait_for(
+                    lambda: not any(match(*key_name) for key_name in self.in_flight), timeout)
+            finally:
+                self.waiters -= 1
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.pending) + len(self.in_flight)
+
+    def nbytes(self):
+        with self.cond:
+            return self.dirty_bytes + self.in_flight_bytes
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class ShardedWriteQueue:
+    """
+    Spreads writes over several CoalescingWriteQueues by (key, name) so each
+    entry is always handled by the same writer, keeping per entry ordering,
+    while distinct entries are written in parallel.
+    """
+
+    def __init__(self, shard_count=1, max_items=None, max_bytes=None, **kwargs):
+        # the bounds are split evenly over the shards
+        if max_items is not None:
+            max_items = max(1, max_items // shard_count)
+        if max_bytes is not None:
+            max_bytes = max(1, max_bytes // shard_count)
+        self.shards = [CoalescingWriteQueue(max_items=max_items, max_bytes=max_bytes, **kwargs)
+                       for _ in range(shard_count)]
+
+    def shard_for(self, key, name):
+        if len(self.shards) == 1:
+            return self.shards[0]
+        return self.shards[hash((key, name)) % len(self.shards)]
+
+    def put(self, item, version=None, size=None):
+        key, name, _, _ = item
+        return self.shard_for(key, name).put(item, version, size)
+
+    def flush(self, timeout=None):
+        # request on every shard first so they all write concurrently
+        seqs = [shard.request_flush() for shard in self.shards]
+        deadline = None if timeout is None else time.time() + timeout
+        for shard, seq in zip(self.shards, seqs):
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            if not shard.wait(seq, timeout=remaining):
+                return False
+        return True
+
+    def flush_entry(self, key, name, timeout=None):
+        return self.shard_for(key, name).flush_entry(key, name, timeout=timeout)
+
+    def cancel(self, match, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        for shard in self.shards:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            if not shard.cancel(match, timeout=remaining):
+                return False
+        return True
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def qsize(self):
+        return sum(shard.qsize() for shard in self.shards)
+
+    def nbytes(self):
+        return sum(shard.nbytes() for shard in self.shards)
+
+    def stats(self):
+        return {
+            'depth': self.qsize(),
+            'bytes': self.nbytes(),
+            'blocked': sum(shard.blocked for shard in self.shards),
+            'sync_writes': sum(shard.rejected for shard in self.shards)}
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class EntryCache:
+    """
+    In memory cache of entries keyed by (key, name), bounded by an entry
+    count and an approximate byte budget with least recently used eviction.
+
+    Entries with writes that are not on disk yet are dirty and never
+    evicted. Every change marks the entry dirty with a new version, the
+    writer marks it clean once that version has been written.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.key_names: Dict[Tuple, set] = {}
+        self.dirty: Dict[Tuple, int] = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, name):
+        with self.lock:
+            entry = self.entries.get((key, name))
+            if entry is not None:
+                self.entries.move_to_end((key, name))
+            return entry
+
+    def put(self, key, name, entry, dirty=False):
+        with self.lock:
+            entry['size'] = approx_size(entry['value'])
+            old = self.entries.pop((key, name), None)
+            if old is not None:
+                self.nbytes -= old['size']
+            self.entries[(key, name)] = entry
+            self.key_names.setdefault(key, set()).add(name)
+            self.nbytes += entry['size']
+            if dirty:
+                self.mark_dirty(key, name)
+            self._evict()
+
+    def pop(self, key, name):
+        with self.lock:
+            entry = self.entries.pop((key, name), None)
+            self.dirty.pop((key, name), None)
+            if entry is not None:
+                self.nbytes -= entry['size']
+                names = self.key_names.get(key)
+                names.discard(name)
+                if not names:
+                    del self.key_names[key]
+            return entry
+
+    def pop_prefix(self, key):
+        """Drops the entries of key and of all keys below it."""
+        with self.lock:
+            for entry_key in [k for k in self.key_names if k[:len(key)] == key]:
+                for name in list(self.key_names[entry_key]):
+                    self.pop(entry_key, name)
+
+    def names(self, key):
+        with self.lock:
+            return list(self.key_names.get(key, ()))
+
+    def drop_value(self, key, name):
+        """Frees the value of an entry while keeping its metadata."""
+        with self.lock:
+            entry = self.entries.get((key, name))
+            if entry is not None:
+                self.nbytes -= entry['size']
+                entry['value'] = None
+                entry['size'] = 0
+
+    def mark_dirty(self, key, name):
+        """
+        Marks the entry as changed and returns the new version. Changed
+        values are put again, which measures their size.
+        """
+        with self.lock:
+            version = self.dirty.get((key, name), 0) + 1
+            self.dirty[(key, name)] = version
+            return version
+
+    def mark_clean(self, key, name, version):
+        with self.lock:
+            if self.dirty.get((key, name)) == version:
+                del self.dirty[(key, name)]
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def _evict(self):
+        if self.max_entries is None and self.max_bytes is None:
+            return
+        # Dirty entries are moved to the end, so each entry is looked at once
+        for _ in range(len(self.entries)):
+            if not ((self.max_entries is not None and len(self.entries) > self.max_entries)
+                    or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                return
+            cache_key, entry = next(iter(self.entries.items()))
+            if cache_key in self.dirty:
+                self.entries.move_to_end(cache_key)
+                continue
+            self.pop(*cache_key)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'dirty': len(self.dirty),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class MetadataCache(OrderedDict):
+    """
+    (stype, mtime, checked_at) of the entries looked up so far, missing ones
+    included, keyed by (key, name). Holds at most max_entries, the entries
+    set longest ago are dropped first.
+    """
+    DEFAULT_MAX_ENTRIES = 100000
+
+    def __init__(self, max_entries=None):
+        super().__init__()
+        self.max_entries = max_entries if max_entries is not None else self.DEFAULT_MAX_ENTRIES
+        self.lock = threading.Lock()
+
+    def __setitem__(self, cache_key, meta):
+        with self.lock:
+            OrderedDict.__setitem__(self, cache_key, meta)
+            self.move_to_end(cache_key)
+            while len(self) > self.max_entries:
+                self.popitem(last=False)
+
+
+class FileStorage:
+    """
+    Stores every entry in its own file, root_path/key.../name.stype. This is
+    the default storage, the files can be used directly by other tools.
+    """
+    # writes of a writer thread are only committed as a group with durability="group"
+    batches_writes = False
+
+    def __init__(self, root_path, read_only=False, durability="none"):
+        self.root_path = root_path
+        self.durability = durability
+        # directories known to exist, so each is created at most once
+        self.known_dirs = set()
+        if not read_only and not os.path.exists(self.root_path):
+            os.makedirs(self.root_path)
+
+    def path(self, key, create=False):
+        """
+        Returns the directory of key. Lookups never touch the file system,
+        writers pass create=True to make sure the directory exists.
+        """
+        path = os.path.join(*[str(k) for k in [self.root_path] + list(key)])
+        if create:
+            self.check_path(path)
+        return path
+
+    def check_path(self, path):
+        if path in self.known_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        self.known_dirs.add(path)
+
+    def filepath(self, key, name, stype):
+        return os.path.join(self.path(key), "{}.{}".format(name, stype.lower()))
+
+    def stat(self, key, name, stype=None):
+        """
+        Returns (stype, mtime) of the entry, probing the file types when
+        stype is None. stype is None if no file exists, mtime is None if the
+        file for the requested stype does not exist.
+        """
+        if stype is None:
+            stype = get_filetype(os.path.join(self.path(key), str(name)))
+            if stype is None:
+                return None, None
+        try:
+            st = os.stat(self.filepath(key, name, stype))
+        except OSError:
+            return stype, None
+        if not stat.S_ISREG(st.st_mode):
+            return stype, None
+        return stype, st.st_mtime
+
+    def load(self, key, name, stype, serializer, options, mmap=False):
+        return serializer.load(self.filepath(key, name, stype), options, mmap=mmap)
+
+    def open(self, key, name, stype):
+        """Returns the entry opened for binary reading or None."""
+        try:
+            return open(self.filepath(key, name, stype), 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+
+    def size(self, key, name, stype):
+        try:
+            return os.path.getsize(self.filepath(key, name, stype))
+        except OSError:
+            return None
+
+    def write(self, key, name, stype, data, group=None):
+        """
+        Writes data to a temporary file and moves it over the entry. Returns
+        the new mtime, or None if the write was added to group and only
+        takes effect with commit.
+        """
+        path = self.path(key, create=True)
+        filepath = os.path.join(path, "{}.{}".format(name, stype.lower()))
+        # one temporary file per writer thread and process, so concurrent
+        # writers of an entry never write into each others files. Hidden,
+        # scan and entries skip it.
+        filepath_tmp = os.path.join(path, ".{}.{}.{}.{}.tmp".format(
+            name, os.getpid(), threading.get_ident(), stype.lower()))
+        try:
+            f = open(filepath_tmp, 'wb')
+        except FileNotFoundError:
+            # directory was removed behind our back
+            self.known_dirs.discard(path)
+            self.check_path(path)
+            f = open(filepath_tmp, 'wb')
+        try:
+            with f:
+                f.write(data)
+                if self.durability == "fsync":
+                    f.flush()
+                    os.fsync(f.fileno())
+        except BaseException:
+            os.remove(filepath_tmp)
+            raise
+        if self.durability == "group":
+            item = (key, name, stype, filepath_tmp, filepath)
+            if group is not None:
+                group.append(item)
+                return None
+            # not on a writer thread, there is no group to join
+            return self.commit([item])[0][3]
+        os.replace(filepath_tmp, filepath)
+        if self.durability == "fsync":
+            fsync_dir(path)
+        return os.stat(filepath).st_mtime
+
+    def commit(self, group):
+        """
+        fsyncs the temporary files of a group, moves them into place and
+        fsyncs their directories once. Returns (key, name, stype, mtime) of
+        the committed entries.
+        """
+        for _, _, _, filepath_tmp, _ in group:
+            fd = os.open(filepath_tmp, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        dirs = set()
+        committed = []
+        for key, name, stype, filepath_tmp, filepath in group:
+            os.replace(filepath_tmp, filepath)
+            dirs.add(os.path.dirname(filepath))
+            committed.append((key, name, stype, os.stat(filepath).st_mtime))
+        for path in dirs:
+            fsync_dir(path)
+        group.clear()
+        return committed
+
+    def append(self, key, name, stype, data):
+        filepath = os.path.join(self.path(key, create=True), "{}.{}".format(name, stype.lower()))
+        with open(filepath, 'ab') as f:
+            f.write(data)
+
+    def remove(self, key, name, stype=None):
+        if stype is None:
+            stype = get_filetype(os.path.join(self.path(key), str(name)))
+        if stype is None:
+            return
+        filepath = self.filepath(key, name, stype)
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+
+    def rename(self, key, name, new_name, stype):
+        """Atomically renames an entry, replacing new_name if it exists."""
+        os.replace(self.filepath(key, name, stype), self.filepath(key, new_name, stype))
+
+    def remove_tree(self, key):
+        """Removes key with all its entries and sub keys."""
+        path = self.path(key)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        self.known_dirs = {p for p in self.known_dirs
+                           if p != path and not p.startswith(path + os.sep)}
+
+    def remove_key_if_empty(self, key):
+        """Removes the directory of key if it is empty. Returns True if it was removed."""
+        if len(key) == 0:
+            return False
+        path = self.path(key)
+        try:
+            # fails without listing the directory when it is not empty
+            os.rmdir(path)
+        except OSError:
+            return False
+        self.known_dirs.discard(path)
+        return True
+
+    def version(self, key):
+        """
+        Returns a value that changes whenever names or sub keys are added to
+        or removed from key, the mtime of its directory. None if it can not
+        be trusted because the directory changed within the mtime resolution.
+        """
+        try:
+            mtime = os.stat(self.path(key)).st_mtime_ns
+        except OSError:
+            return 0
+        if time.time_ns() - mtime < 2000000000:
+            return None
+        return mtime
+
+    def scan(self, key):
+        """
+        Returns ({name: stype}, subkeys) of key using a single directory
+        scan. When several files share a name the first in SUPPORTED_FILE_TYPES
+        wins, like get_filetype.
+        """
+        stypes = {}
+        subkeys = []
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return stypes, subkeys
+        order = {stype: i for i, stype in enumerate(SUPPORTED_FILE_TYPES)}
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                if dir_entry.name.startswith("."):
+                    # lock files and other bookkeeping
+                    continue
+                if dir_entry.is_dir():
+                    subkeys.append(dir_entry.name)
+                    continue
+                name, stype = split_stype(dir_entry.name)
+                if stype not in order or name.endswith("_tmp"):
+                    continue
+                current = stypes.get(name)
+                if current is None or order[stype] < order[current]:
+                    stypes[name] = stype
+        return stypes, subkeys
+
+    def entries(self):
+        """Yields (key, name, stype, data) for every entry."""
+        for path, dirs, files in os.walk(self.root_path):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            key = format_key(os.path.relpath(path, self.root_path).split(os.sep)) if path != self.root_path else ()
+            for fname in files:
+                name, stype = split_stype(fname)
+                if stype not in SERIALIZERS or name.endswith("_tmp") or name.startswith("."):
+                    continue
+                with open(os.path.join(path, fname), 'rb') as f:
+                    yield key, name, stype, f.read()
+
+    def close(self):
+        pass
+
+
+class PackedStorage:
+    """
+    Stores all entries in a single SQLite file, root_path/deadsimpledb.sqlite.
+    Meant for millions of tiny entries where a file per entry is dominated
+    by inode and directory overhead. DeadSimpleDB.export writes the entries
+    out in the per file layout.
+    """
+    FILENAME = "deadsimpledb.sqlite"
+    # the writes of a writer thread are committed in one transaction
+    batches_writes = True
+
+    def __init__(self, root_path, read_only=False, durability="none"):
+        self.root_path = root_path
+        self.filepath = os.path.join(root_path, self.FILENAME)
+        self.read_only = read_only
+        # in WAL mode NORMAL survives crashes of the process but may lose the
+        # last commits on power loss, FULL syncs the WAL on every commit
+        self.synchronous = {"none": "NORMAL", "fsync": "FULL", "group": "FULL"}[durability]
+        # sqlite connections can not be shared between threads
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        if not read_only:
+            os.makedirs(self.root_path, exist_ok=True)
+            self.conn().execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT NOT NULL, name TEXT NOT NULL, stype TEXT NOT NULL, "
+                "data BLOB NOT NULL, mtime REAL NOT NULL, PRIMARY KEY (key, name))")
+
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            return conn
+        if self.read_only:
+            if not os.path.exists(self.filepath):
+                return None
+            conn = sqlite3.connect("file:{}?mode=ro".format(self.filepath),
+                uri=True, timeout=30, isolation_level=None, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.filepath,
+                timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous={}".format(self.synchronous))
+        self.local.conn = conn
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    def _query(self, sql, params=()):
+        conn = self.conn()
+        if conn is None:
+            return []
+        return conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def encode_key(key):
+        return "/".join(key)
+
+    def stat(self, key, name, stype=None):
+        rows = self._query("SELECT stype, mtime FROM entries WHERE key=? AND name=?",
+            (self.encode_key(key), str(name)))
+        if not rows or (stype is not None and rows[0][0] != stype):
+            return stype, None
+        return rows[0]
+
+    def _data(self, key, name, stype):
+        rows = self._query("SELECT data FROM entries WHERE key=? AND name=? AND stype=?",
+            (self.encode_key(key), str(name), stype))
+        return rows[0][0] if rows else None
+
+    def load(self, key, name, stype, serializer, options, mmap=False):
+        data = self._data(key, name, stype)
+        if data is None:
+            raise FileNotFoundError("{}/{}.{}".format(self.encode_key(key), name, stype))
+        return serializer.loads(data, options)
+
+    def open(self, key, name, stype):
+        data = self._data(key, name, stype)
+        return None if data is None else io.BytesIO(data)
+
+    def size(self, key, name, stype):
+        rows = self._query("SELECT length(data) FROM entries WHERE key=? AND name=? AND stype=?",
+            (self.encode_key(key), str(name), stype))
+        return rows[0][0] if rows else None
+
+    def write(self, key, name, stype, data, group=None):
+        mtime = time.time()
+        row = (self.encode_key(key), str(name), stype, data, mtime)
+        if group is not None:
+            group.append((key, name, row))
+            return None
+        self.conn().execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", row)
+        return mtime
+
+    def commit(self, group):
+        conn = self.conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                [row for _, _, row in group])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        committed = [(key, name, row[2], row[4]) for key, name, row in group]
+        group.clear()
+        return committed
+
+    def append(self, key, name, stype, data):
+        # blobs can not be appended to in place, the row is rewritten
+        conn = self.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = self._data(key, name, stype)
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (self.encode_key(key), str(name), stype, (old or b"") + data, time.time()))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def remove(self, key, name, stype=None):
+        if stype is None:
+            self._query("DELETE FROM entries WHERE key=? AND name=?", (self.encode_key(key), str(name)))
+        else:
+            self._query("DELETE FROM entries WHERE key=? AND name=? AND stype=?",
+                (self.encode_key(key), str(name), stype))
+
+    def rename(self, key, name, new_name, stype):
+        conn = self.conn()
+        encoded = self.encode_key(key)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM entries WHERE key=? AND name=?", (encoded, str(new_name)))
+            conn.execute("UPDATE entries SET name=? WHERE key=? AND name=? AND stype=?",
+                (str(new_name), encoded, str(name), stype))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def remove_tree(self, key):
+        encoded = self.encode_key(key)
+        if not encoded:
+            self._query("DELETE FROM entries")
+            return
+        self._query("DELETE FROM entries WHERE key=? OR (key >= ? AND key < ?)",
+            (encoded, encoded + "/", encoded + "0"))
+
+    def remove_key_if_empty(self, key):
+        # keys only exist through their entries, nothing to remove
+        encoded = self.encode_key(key)
+        if not encoded or self._query("SELECT 1 FROM entries WHERE key=? LIMIT 1", (encoded,)):
+            return False
+        return not self._query("SELECT 1 FROM entries WHERE key >= ? AND key < ? LIMIT 1",
+            (encoded + "/", encoded + "0"))
+
+    def _subkeys(self, key):
+        encoded = self.encode_key(key)
+        if encoded:
+            # '0' sorts right after '/', the range holds all keys below key
+            rows = self._query("SELECT DISTINCT key FROM entries WHERE key >= ? AND key < ?",
+                (encoded + "/", encoded + "0"))
+            start = len(encoded) + 1
+        else:
+            rows = self._query("SELECT DISTINCT key FROM entries WHERE key != ''")
+            start = 0
+        subkeys = OrderedDict()
+        for (k,) in rows:
+            subkeys[k[start:].split("/", 1)[0]] = None
+        return list(subkeys)
+
+    def version(self, key):
+        # changes with every commit of another connection, connections are per thread
+        conn = self.conn()
+        if conn is None:
+            return None
+        return id(conn), conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def scan(self, key):
+        rows = self._query("SELECT name, stype FROM entries WHERE key=?", (self.encode_key(key),))
+        return dict(rows), self._subkeys(key)
+
+    def entries(self):
+        conn = self.conn()
+        if conn is None:
+            return
+        for k, name, stype, data in conn.execute("SELECT key, name, stype, data FROM entries"):
+            yield (tuple(k.split("/")) if k else ()), name, stype, data
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+
+class KeyIndexNode:
+    """Names and sub keys of one key, kept sorted for paging."""
+    __slots__ = ("stypes", "names", "subkeys", "version")
+
+    def __init__(self, stypes, subkeys, version=None):
+        self.stypes = stypes
+        self.names = sorted(stypes)
+        self.subkeys = sorted(subkeys)
+        self.version = version
+
+
+class KeyIndex:
+    """
+    In memory index of the names and sub keys of the keys listed so far.
+    A key is read from storage with a single scan the first time it is
+    needed, afterwards our own writes and deletes keep it up to date. The
+    storage version of the key (eg. the directory mtime) is checked on
+    every lookup and the key is scanned again when other processes changed it.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.nodes: Dict[Tuple, KeyIndexNode] = {}
+        self.lock = threading.RLock()
+
+    def node(self, key, refresh=False):
+        with self.lock:
+            node = self.nodes.get(key)
+            # taken before the scan, a change during the scan shows up next time
+            version = self.storage.version(key)
+            if node is None or refresh or version is None or version != node.version:
+                # scanned under the lock so no write can slip in between
+                node = KeyIndexNode(*self.storage.scan(key), version=version)
+                self.nodes[key] = node
+            return node
+
+    def add(self, key, name, stype):
+        with self.lock:
+            node = self.nodes.get(key)
+            if node is not None and name not in node.stypes:
+                node.stypes[name] = stype
+                bisect.insort(node.names, name)
+            # a new key also shows up in every listed parent
+            for i in range(len(key) - 1, -1, -1):
+                parent = self.nodes.get(key[:i])
+                if parent is None:
+                    continue
+                idx = bisect.bisect_left(parent.subkeys, key[i])
+                if idx < len(parent.subkeys) and parent.subkeys[idx] == key[i]:
+                    break
+                parent.subkeys.insert(idx, key[i])
+
+    def remove(self, key, name):
+        with self.lock:
+            node = self.nodes.get(key)
+            if node is not None and node.stypes.pop(name, None) is not None:
+                node.names.pop(bisect.bisect_left(node.names, name))
+
+    def remove_key(self, key):
+        with self.lock:
+            self.nodes.pop(key, None)
+            parent = self.nodes.get(key[:-1]) if len(key) > 0 else None
+            if parent is not None:
+                idx = bisect.bisect_left(parent.subkeys, key[-1])
+                if idx < len(parent.subkeys) and parent.subkeys[idx] == key[-1]:
+                    parent.subkeys.pop(idx)
+
+    def remove_tree(self, key):
+        with self.lock:
+            for node_key in [k for k in self.nodes if k[:len(key)] == key]:
+                del self.nodes[node_key]
+            if len(key) > 0:
+                self.remove_key(key)
+
+    def clear(self):
+        with self.lock:
+            self.nodes.clear()
+
+    @staticmethod
+    def page(values, prefix=None, offset=0, limit=None):
+        """Slices a sorted list to the values starting with prefix, offset and limit."""
+        start, end = 0, len(values)
+        if prefix:
+            start = bisect.bisect_left(values, prefix)
+            end = bisect.bisect_left(values, prefix + "\U0010ffff", start)
+        start = min(start + offset, end)
+        if limit is not None:
+            end = min(end, start + limit)
+        return values[start:end]
+
+
+class EntryLocks:
+    """
+    Advisory fcntl locks on entries shared by all processes using the same
+    root_path. Entries are hashed onto a fixed number of lock files in
+    root_path/.locks so the number of files stays bounded. flock only
+    excludes other processes, threads of this process also take a thread
+    lock per stripe.
+    """
+
+    def __init__(self, root_path, stripes=256):
+        import fcntl
+        self.fcntl = fcntl
+        self.path = os.path.join(root_path, ".locks")
+        os.makedirs(self.path, exist_ok=True)
+        self.stripes = stripes
+        self.thread_locks = [threading.Lock() for _ in range(stripes)]
+        self.fds: Dict[int, int] = {}
+        self.pid = os.getpid()
+
+    def _fd(self, stripe):
+        if self.pid != os.getpid():
+            # a forked child shares the open files and with them the locks
+            self.fds = {}
+            self.thread_locks = [threading.Lock() for _ in range(self.stripes)]
+            self.pid = os.getpid()
+        fd = self.fds.get(stripe)
+        if fd is None:
+            fd = os.open(os.path.join(self.path, "{}.lock".format(stripe)), os.O_RDWR | os.O_CREAT, 0o666)
+            self.fds[stripe] = fd
+        return fd
+
+    @contextlib.contextmanager
+    def lock(self, key, name):
+        stripe = zlib.crc32("{}/{}".format("/".join(key), name).encode('utf-8')) % self.stripes
+        fd = self._fd(stripe)
+        with self.thread_locks[stripe]:
+            self.fcntl.flock(fd, self.fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self.fcntl.flock(fd, self.fcntl.LOCK_UN)
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+
+class LatencyHistogram:
+    """Latencies in power of two microsecond buckets."""
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * 32
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[min(31, int(seconds * 1000000).bit_length())] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Upper bound in seconds of the bucket holding the fraction percentile."""
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min(self.max, (1 << i) / 1000000)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max}
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the database operations. Every
+    observation is also passed to the hooks as hook(event, seconds, info)
+    where info holds eg. key, name, stype and bytes.
+    """
+
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks or [])
+        self.lock = threading.Lock()
+        self.counters: Dict[str, int] = {}
+        self.latencies: Dict[str, LatencyHistogram] = {}
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def observe(self, event, seconds, **info):
+        with self.lock:
+            histogram = self.latencies.get(event)
+            if histogram is None:
+                histogram = self.latencies[event] = LatencyHistogram()
+            histogram.add(seconds)
+        for hook in self.hooks:
+            try:
+                hook(event, seconds, info)
+            except Exception:
+                logging.exception("Metrics hook failed for {}".format(event))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'latency': {event: h.summary() for event, h in self.latencies.items()}}
+
+
+STORAGES = {
+    'files': FileStorage,
+    'packed': PackedStorage}
+
+
+def _close_at_exit(db_ref):
+    db = db_ref()
+    if db is not None:
+        db.close()
 
 
 class DeadSimpleDB:
@@ -77,14 +1716,47 @@ class DeadSimpleDB:
     def __init__(self, 
         root_path=None, 
         overwrite=False, 
-        json_encoder=JSONEncoderDefault, 
-        json_decoder=JSONDecoderDefault,
+        json_encoder=None,
+        json_decoder=None,
         read_only=False,
         use_write_thread=True,
-        check_file_last_updated = True): ## this is a write optmization
+        check_file_last_updated = True, ## this is a write optmization
+        max_write_latency=1.0,
+        max_dirty_bytes=64 * 1024 * 1024,
+        writer_threads=1,
+        encode_processes=0,
+        multipart_segment_bytes=1024 * 1024,
+        cache_max_entries=None,
+        cache_max_bytes=None,
+        metadata_ttl=0,
+        json_backend="simplejson",
+        png_compress_level=None,
+        jpg_quality=None,
+        io_threads=8,
+        durability="none",
+        group_fsync_interval=50,
+        storage="files",
+        key_index=None,
+        snapshot="none",
+        metrics=False,
+        hooks=None,
+        multi_process=False,
+        dict_delta_log=False,
+        dict_delta_compact_bytes=1024 * 1024,
+        row_index_step=10000,
+        max_queue_items=None,
+        max_queue_bytes=None,
+        queue_overflow="block"):
 
         self.json_encoder = json_encoder
         self.json_decoder = json_decoder
+        # settings passed to the serializers
+        self.serializer_options = {
+            'json_encoder': json_encoder,
+            'json_decoder': json_decoder,
+            'json_backend': json_backend,
+            'png_compress_level': png_compress_level,
+            'jpg_quality': jpg_quality}
 
         if root_path is None:
             root_path = "deadsimpledb"
@@ -100,71 +1772,397 @@ class DeadSimpleDB:
             else:
                 logging.info("No folder exists, not overwriting")
 
-        if not os.path.exists(self.root_path):
-            os.makedirs(self.root_path)
         self.read_only = read_only
         self.running = True
         if self.read_only:
             self.use_write_thread = False
 
         self.check_file_last_updated = check_file_last_updated
-        self.data_store: Dict[str, Dict[str, Any]] = {}
+        self.data_store = EntryCache(
+            max_entries=cache_max_entries,
+            max_bytes=cache_max_bytes)
         self.cache: Dict[str, Dict[str, Any]] = {}
+        self.multipart_segment_bytes = multipart_segment_bytes
+        # (key, name) -> (stype, mtime, checked_at), stype is None for missing
+        # files. Bounded like the entry cache, misses would grow it forever.
+        self.file_metadata = MetadataCache(max_entries=cache_max_entries)
+        self.metadata_ttl = metadata_ttl
+        self.multipart_logs: Dict[Tuple, Dict[str, Any]] = {}
+        # values appended to multipart lists with read_only=True, never written
+        self.multipart_appends: Dict[Tuple, List[Any]] = {}
+        # sparse row offsets of csv entries, see iter_rows
+        self.row_indexes: Dict[Tuple, Dict[str, Any]] = {}
+        self.row_index_step = row_index_step
         self.use_write_thread = use_write_thread
 
+        self.io_threads = io_threads
+        # what the write queue holds until the writer gets to it. none: the
+        # live value, changes made meanwhile are written too. copy: a
+        # structural copy, deepcopy: copy.deepcopy, serialize: the encoded
+        # bytes, encoding errors are raised by save
+        if snapshot not in ("none", "copy", "deepcopy", "serialize"):
+            raise Exception("Unknown snapshot mode {}".format(snapshot))
+        self.snapshot = snapshot
+        # counters and latency histograms, see stats. Passing hooks enables them
+        self.metrics = Metrics(hooks) if metrics or hooks else None
+        # none: leave flushing to the OS, fsync: fsync every file before it
+        # replaces the old one, group: writer threads fsync the files they
+        # wrote together every group_fsync_interval milliseconds
+        if durability not in ("none", "fsync", "group"):
+            raise Exception("Unknown durability mode {}".format(durability))
+        self.durability = durability
+        self.group_fsync_interval = group_fsync_interval
+        # files: a file per entry, packed: all entries in a single sqlite file
+        if storage not in STORAGES:
+            raise Exception("Unknown storage {}".format(storage))
+        self.storage = STORAGES[storage](root_path, read_only=read_only, durability=durability)
+        # Several processes share root_path. update_dict, remove_items_from_dict,
+        # append_to_list and multipart appends hold a lock on the entry and
+        # write synchronously, changes of other processes are picked up by
+        # the last updated checks of get
+        self.multi_process = multi_process
+        self.entry_locks = EntryLocks(root_path) if multi_process and not read_only else None
+        # answers list from memory, key_index=False rescans the storage every
+        # time. Off by default with multi_process as other processes add keys
+        self.key_index = KeyIndex(self.storage)
+        self.use_key_index = not multi_process if key_index is None else key_index
+        # update_dict and remove_items_from_dict on json dicts append patch
+        # records to name__delta.jsonl instead of rewriting the file, reads
+        # apply them. Past dict_delta_compact_bytes the patches are merged
+        # back into the json file in the background
+        self.dict_delta_log = dict_delta_log
+        self.dict_delta_compact_bytes = dict_delta_compact_bytes
+        self.dict_delta_sizes: Dict[Tuple, int] = {}
+        self.dict_delta_compacting = set()
+        self.dict_delta_lock = threading.RLock()
+        # holds the writes of the current group commit of each writer thread
+        self.write_local = threading.local()
+        self.io_pool = None
+        self.encode_pool = None
+        self.encode_processes = encode_processes
+        # the writer threads are started by the first write
+        self.writer_threads = None
+        self.close_at_exit = None
+        self.writers_lock = threading.Lock()
         if self.use_write_thread:
-            self.write_queue= Queue()
-            self.writer_thread = threading.Thread(target=self._process_write_requests, args=())
-            self.writer_thread.daemon = True
-            self.writer_thread.start()
-        else:
-            print("Not using write thread")
+            # max_queue_items/max_queue_bytes bound the writes waiting for the
+            # writers, a full queue blocks save or with queue_overflow="sync"
+            # makes it write on the calling thread
+            if queue_overflow not in ("block", "sync"):
+                raise Exception("Unknown queue overflow policy {}".format(queue_overflow))
+            self.write_queue = ShardedWriteQueue(
+                shard_count=writer_threads,
+                max_latency=max_write_latency,
+                max_dirty_bytes=max_dirty_bytes,
+                max_items=max_queue_items,
+                max_bytes=max_queue_bytes,
+                overflow=queue_overflow)
 
-    def _process_write_requests(self):
-        print("Write Thread initialized")
-        running = True
-        
-        t = threading.currentThread()
-        while running:
+    def _start_writers(self):
+        with self.writers_lock:
+            if self.writer_threads is not None:
+                return
+            if self.encode_processes > 0:
+                self.encode_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.encode_processes)
+            writer_threads = []
+            for shard in self.write_queue.shards:
+                writer_thread = threading.Thread(target=self._process_write_requests, args=(shard,))
+                writer_thread.daemon = True
+                writer_thread.start()
+                writer_threads.append(writer_thread)
+            self.writer_threads = writer_threads
+            # the writers are daemon threads, writes still queued when the
+            # interpreter exits are written by close. Only a weak reference
+            # is kept so the database can still be garbage collected.
+            self.close_at_exit = functools.partial(_close_at_exit, weakref.ref(self))
+            atexit.register(self.close_at_exit)
+
+    def _process_write_requests(self, write_queue):
+        while True:
+            batch = write_queue.get_batch()
+            if batch is None:
+                return
             try:
-                key,name,value,stype = self.write_queue.get(timeout=3)
-                try:
-                    self._write(key,value,name,stype)
-                except Exception as e:
-                    print("Exception while writing for root_path:{}, key:{}, name: {} --- {}".format(self.root_path,key,name,e))
-            except Exception as e:
-                pass
-            running = getattr(t, "running", True)
-            if not running and not self.write_queue.empty():
-                running = True
-                
-    def check_path(self, path):
-        if not os.path.exists(path):
-            os.makedirs(path, exist_ok=True)
+                self._write_batch(write_queue, batch)
+            except Exception:
+                logging.exception("Exception while writing a batch for root_path:{}".format(self.root_path))
+                # whatever was not released yet stays dirty, the writer carries on
+                for (key, name), _ in batch:
+                    write_queue.done(key, name)
+            finally:
+                self.write_local.group = None
+
+    def _submit_encode(self, pending):
+        """Returns a future encoding pending in the process pool, None to encode here."""
+        if self.encode_pool is None or type(pending.value) is EncodedValue:
+            return None
+        serializer = get_serializer(pending.stype)
+        if serializer is None or not serializer.cpu_bound:
+            return None
+        try:
+            return self.encode_pool.submit(
+                encode_value, pending.value, pending.stype, self.serializer_options)
+        except Exception:
+            # broken or shut down (eg. at interpreter exit)
+            return None
+
+    def _write_batch(self, write_queue, batch):
+        # Submit CPU heavy encodes first so they run while the rest of the batch is written
+        encoded = {}
+        for (key, name), pending in batch:
+            future = self._submit_encode(pending)
+            if future is not None:
+                encoded[(key, name)] = future
+        # With group durability writes only count as done once their group is committed
+        group = [] if self.durability == "group" or self.storage.batches_writes else None
+        self.write_local.group = group
+        group_started = time.time()
+        finished = []
+        for (key, name), pending in batch:
+            written = False
+            try:
+                if self.metrics is not None:
+                    self.metrics.observe("queue_wait", time.time() - pending.enqueued_at,
+                                         key=key, name=name, stype=pending.stype)
+                future = encoded.get((key, name))
+                if type(pending.value) is EncodedValue:
+                    self._write_bytes(key, name, pending.stype, pending.value.data)
+                elif future is None:
+                    self._write(key, pending.value, name, pending.stype)
+                else:
+                    try:
+                        data = future.result()
+                    except Exception:
+                        logging.warning("Encoding in the process pool failed, encoding key:{}, name:{} on the writer".format(key, name))
+                        data = encode_value(pending.value, pending.stype, self.serializer_options)
+                    self._write_bytes(key, name, pending.stype, data)
+                written = True
+            except Exception:
+                logging.exception("Exception while writing for root_path:{}, key:{}, name: {}".format(self.root_path,key,name))
+                if self.metrics is not None:
+                    self.metrics.count("write_errors")
+            finished.append((key, name, pending.version if written else None))
+            if group is None or time.time() - group_started >= self.group_fsync_interval / 1000:
+                self._finish_writes(write_queue, group, finished)
+                group_started = time.time()
+        self._finish_writes(write_queue, group, finished)
+
+    def _finish_writes(self, write_queue, group, finished):
+        """
+        Commits the pending group, marks the written entries clean and
+        releases everyone waiting on them.
+        """
+        if group:
+            try:
+                self._commit_group(group)
+            except Exception:
+                logging.exception("Exception while committing writes for root_path:{}".format(self.root_path))
+                if self.metrics is not None:
+                    self.metrics.count("write_errors", len(group))
+                group.clear()
+                # nothing of the group is known to be on disk, keep the entries dirty
+                finished[:] = [(key, name, None) for key, name, _ in finished]
+        for key, name, version in finished:
+            if version is not None:
+                self.data_store.mark_clean(key, name, version)
+            write_queue.done(key, name)
+        finished.clear()
+
+    def _locked_update(self, key, name, stype, clear_cache, update):
+        """
+        Read-modify-write of an entry under its lock for multi_process. The
+        entry is read from storage and written before the lock is released.
+        update returns the new value or None to leave the entry as is.
+        """
+        # our own queued changes have to be on disk before reading it back
+        self.flush(key, name)
+        with self.entry_locks.lock(key, name):
+            value = update(self._get(key, name, stype=stype, refresh=True))
+            if value is None:
+                return
+            # dirty so it can not be evicted before it is written
+            with self.data_store.lock:
+                self.save(key, name=name, value=value, stype=stype, flush=False)
+                self.data_store.mark_dirty(key, name)
+            self._flush_sync_replacing(key, name, stype, clear_cache)
 
     def update_dict(self, key, value, name='data', stype="json", clear_cache=False):
         key = format_key(key)
+        if self.entry_locks is not None:
+            def update(value_dict):
+                value_dict = {} if value_dict is None else value_dict
+                value_dict.update(value)
+                return value_dict
+            return self._locked_update(key, name, stype, clear_cache, update)
         value_dict = self.get(key, name, stype=stype)
         if value_dict is None:
             value_dict = {}
             value_dict.update(value)
             self.save(key, name=name, value=value_dict, stype=stype, clear_cache=clear_cache)
+        elif self.dict_delta_log and stype == "json" and type(value_dict) is dict:
+            value_dict.update(value)
+            self._append_dict_delta(key, name, {'set': value})
+        else:
+            value_dict.update(value)
+            # saved again, the entry returned by get is clean and may already
+            # have been evicted
+            self.save(key, name=name, value=value_dict, stype=stype, clear_cache=clear_cache)
+
+    def remove_items_from_dict(self, key, items, name='data', stype="json", clear_cache=False):
+        key = format_key(key)
+        if self.entry_locks is not None:
+            def update(value_dict):
+                if value_dict is not None:
+                    for item in items:
+                        value_dict.pop(item, None)
+                return value_dict
+            return self._locked_update(key, name, stype, clear_cache, update)
+
+        value_dict = self.get(key, name, stype=stype)
+        if value_dict is None:
+            return
+        for item in items:
+            value_dict.pop(item, None)
+        if self.dict_delta_log and stype == "json" and type(value_dict) is dict:
+            self._append_dict_delta(key, name, {'del': list(items)})
+        else:
+            self.save(key, name=name, value=value_dict, stype=stype, clear_cache=clear_cache)
+
+    def _dict_delta_names(self, name):
+        """Names of the active patch log and of the one being compacted."""
+        return "{}__delta".format(name), "{}__delta_compacting".format(name)
+
+    def _dict_delta_size(self, key, name):
+        size = self.dict_delta_sizes.get((key, name))
+        if size is None:
+            size = sum(self.storage.size(key, delta_name, 'jsonl') or 0
+                       for delta_name in self._dict_delta_names(name))
+            self.dict_delta_sizes[(key, name)] = size
+        return size
+
+    def _has_dict_deltas(self, key, name):
+        """True if key/name has patches or its patches are being compacted."""
+        return (key, name) in self.dict_delta_compacting or self._dict_delta_size(key, name) > 0
+
+    def _drop_dict_deltas(self, key, name):
+        """
+        Removes the patch logs of key/name once a full value replaced its
+        json file, they belong to the old value. Called under dict_delta_lock.
+        """
+        for delta_name in self._dict_delta_names(name):
+            self.storage.remove(key, delta_name, 'jsonl')
+            self.key_index.remove(key, delta_name)
+            self.file_metadata.pop((key, delta_name), None)
+        self.dict_delta_sizes[(key, name)] = 0
+
+    def _flush_sync_replacing(self, key, name, stype, clear_cache=False):
+        """
+        Writes the cached entry on the calling thread like _flush_sync and
+        drops the patch logs it replaces. For the full writes that don't
+        go through save.
+        """
+        if self.dict_delta_log and stype == "json" and self._has_dict_deltas(key, name):
+            with self.dict_delta_lock:
+                self.flush(key, name)
+                self._flush_sync(key, name, clear_cache)
+                self._drop_dict_deltas(key, name)
+        else:
+            self._flush_sync(key, name, clear_cache)
+
+    def _append_dict_delta(self, key, name, record):
+        if self.read_only:
+            return
+        line = JSON_SERIALIZER.dumps(record, self.serializer_options) + b"\n"
+        delta_name = self._dict_delta_names(name)[0]
+        with self.dict_delta_lock:
+            size = self._dict_delta_size(key, name)
+            self.storage.append(key, delta_name, 'jsonl', line)
+            self.key_index.add(key, delta_name, 'jsonl')
+            self.file_metadata.pop((key, delta_name), None)
+            if self.check_file_last_updated:
+                # the cached value already has the patch
+                self._set_last_updated(key, name, self._file_metadata(key, delta_name, 'jsonl')[1])
+            self.dict_delta_sizes[(key, name)] = size + len(line)
+            compact = (size + len(line) >= self.dict_delta_compact_bytes
+                       and (key, name) not in self.dict_delta_compacting)
+            if compact:
+                self.dict_delta_compacting.add((key, name))
+        if not compact:
+            return
+        if self.use_write_thread:
+            self._get_io_pool().submit(self._compact_dict_delta, key, name)
         else:
-            value_dict.update(value) 
-            self._flush(key, name, clear_cache)
+            self._compact_dict_delta(key, name)
 
-    def remove_items_from_dict(self, key, items, name='data', stype="json", clear_cache=False):
-        key = format_key(key)
+    def _compact_dict_delta(self, key, name):
+        """
+        Merges the patch log into the json file. The log is first renamed,
+        the renamed log is only removed once the json file holding its
+        patches replaced the old one. Patches are idempotent, a crash at any
+        point at most replays some.
 
-        value_dict = self.get(key, name, stype=stype)
-        if value_dict is None:
-            return
-        for item in items:
-            value_dict.pop(item, None)
-        self._flush(key, name, clear_cache)
+        Runs under dict_delta_lock until the file is written, save waits for
+        it so a newer value can not be overwritten by the compacted one.
+        """
+        delta_name, compacting_name = self._dict_delta_names(name)
+        try:
+            with self.dict_delta_lock:
+                # an older value still queued must not land after the compacted one
+                self.flush(key, name)
+                value = self.get(key, name, stype="json")
+                if value is None:
+                    return
+                value = snapshot_copy(value)
+                f = self.storage.open(key, delta_name, 'jsonl')
+                if f is not None:
+                    if self.storage.size(key, compacting_name, 'jsonl') is None:
+                        f.close()
+                        self.storage.rename(key, delta_name, compacting_name, 'jsonl')
+                    else:
+                        # left over by a crash, keep its patches until the write is done
+                        with f:
+                            self.storage.append(key, compacting_name, 'jsonl', f.read())
+                        self.storage.remove(key, delta_name, 'jsonl')
+                    self.key_index.remove(key, delta_name)
+                    self.key_index.add(key, compacting_name, 'jsonl')
+                self.dict_delta_sizes[(key, name)] = 0
+                self._write(key, value, name, "json")
+                self._set_last_updated(key, name, self._file_metadata(key, name, "json")[1])
+                self.storage.remove(key, compacting_name, 'jsonl')
+                self.key_index.remove(key, compacting_name)
+                for meta_name in (delta_name, compacting_name):
+                    self.file_metadata.pop((key, meta_name), None)
+        except Exception:
+            logging.exception("Compacting the patch log of key:{}, name:{} failed".format(key, name))
+        finally:
+            with self.dict_delta_lock:
+                self.dict_delta_compacting.discard((key, name))
+
+    def _apply_dict_deltas(self, key, name, value):
+        for delta_name in self._dict_delta_names(name):
+            f = self.storage.open(key, delta_name, 'jsonl')
+            if f is None:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        record = JSON_SERIALIZER.loads(line, self.serializer_options)
+                    except ValueError:
+                        # a patch cut short by a crash
+                        continue
+                    value.update(record.get('set', {}))
+                    for item in record.get('del', ()):
+                        value.pop(item, None)
+        return value
 
     def append_to_list(self, key, value, name='data', stype="json", clear_cache=False):
         key = format_key(key)
+        if self.entry_locks is not None:
+            def update(value_list):
+                value_list = [] if value_list is None else value_list
+                value_list.append(value)
+                return value_list
+            return self._locked_update(key, name, stype, clear_cache, update)
         value_list = self.get(key, name, stype=stype)
         if value_list is None:
             value_list = []
@@ -172,20 +2170,26 @@ class DeadSimpleDB:
             self.save(key, name=name, value=value_list, stype=stype, clear_cache=clear_cache)
         else:
             value_list.append(value)
-            self._flush(key, name, clear_cache)
+            self.save(key, name=name, value=value_list, stype=stype, clear_cache=clear_cache)
 
     def get_multipart_list(self,
                          key,
                          name="data",
                          start_idx = 0,
                          end_idx = None):
-  
+        """
+        Returns the elements stored in parts start_idx to end_idx (exclusive)
+        of a multipart list. Only the requested parts are read.
+        See iter_multipart_list for element level access.
+        """
+        key = format_key(key)
         manifest_name = "{}__{}".format(name, "manifest")
 
         manifest = self.get(key = key, name = manifest_name)
+        appended = self.multipart_appends.get((key, name))
 
         if manifest is None:
-            return None
+            return None if appended is None else list(appended)
         
         start_idx = start_idx
         end_idx = end_idx if end_idx else manifest['parts_index'] +1
@@ -193,87 +2197,389 @@ class DeadSimpleDB:
         value_list = []
         for i in range(start_idx,end_idx):
             part_name = "{}__part{}".format(name, i)
-
-            value_list_part = self.get(key=key, name=part_name,stype='json')
-            if value_list_part is not None:
-                value_list.extend(value_list_part)
-            else:
-                print("no data found1")
+            value_list.extend(self._read_multipart_segment(key, part_name))
+        if appended is not None and end_idx > manifest['parts_index']:
+            # held in memory after the part being appended to
+            value_list.extend(appended)
         return value_list
 
+    def iter_multipart_list(self, key, name="data", offset=0, limit=None, tail=None):
+        """
+        Lazily yields the elements of a multipart list.
+
+        offset and limit select elements by position. The element counts of
+        the closed parts are kept in the manifest, so parts before offset
+        are skipped without being opened. tail yields only the last tail
+        elements (offset is ignored) and only reads the parts holding them.
+        """
+        key = format_key(key)
+        manifest = self.get(key=key, name="{}__{}".format(name, "manifest"))
+        appended = self.multipart_appends.get((key, name), [])
+        if manifest is None and not appended:
+            return
+        stored = 0
+        if manifest is not None:
+            counts = self._multipart_part_counts(key, name, manifest)
+            active_idx = manifest['parts_index']
+            if tail is not None or appended:
+                stored = sum(counts) + self._count_multipart_segment(
+                    key, "{}__part{}".format(name, active_idx))
+        if tail is not None:
+            offset = max(0, stored + len(appended) - tail)
+
+        yielded = 0
+        part_start = 0
+        for i in range(active_idx + 1 if manifest is not None else 0):
+            if i < active_idx:
+                if part_start + counts[i] <= offset:
+                    part_start += counts[i]
+                    continue
+            skip = max(0, offset - part_start)
+            part_name = "{}__part{}".format(name, i)
+            for value in self._read_multipart_segment(key, part_name, skip=skip):
+                if limit is not None and yielded >= limit:
+                    return
+                yield value
+                yielded += 1
+            if i < active_idx:
+                part_start += counts[i]
+        for value in appended[max(0, offset - stored):]:
+            if limit is not None and yielded >= limit:
+                return
+            yield value
+            yielded += 1
+
+    def _read_multipart_segment(self, key, part_name, skip=0):
+        """
+        Yields the elements of one part, skipped lines are not decoded.
+        Parts are jsonl segments, manifests written by older versions point
+        to json parts which are still read.
+        """
+        f = self.storage.open(key, part_name, 'jsonl')
+        if f is not None:
+            with f:
+                for line in f:
+                    if skip > 0:
+                        skip -= 1
+                        continue
+                    yield JSON_SERIALIZER.loads(line, self.serializer_options)
+            return
+        value_list_part, _ = self._read(key, part_name, 'json')
+        if value_list_part is not None:
+            yield from value_list_part[skip:]
+
+    def _count_multipart_segment(self, key, part_name):
+        f = self.storage.open(key, part_name, 'jsonl')
+        if f is not None:
+            count = 0
+            with f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    count += chunk.count(b'\n')
+            return count
+        value_list_part, _ = self._read(key, part_name, 'json')
+        return 0 if value_list_part is None else len(value_list_part)
+
+    def _multipart_part_counts(self, key, name, manifest):
+        """
+        Element counts of the closed parts. Counts missing from manifests
+        written by older versions are computed by reading the parts.
+        """
+        counts = list(manifest.get('part_counts', []))
+        for i in range(len(counts), manifest['parts_index']):
+            counts.append(self._count_multipart_segment(key, "{}__part{}".format(name, i)))
+        return counts
+
+    def _get_multipart_log(self, key, name, refresh=False):
+        """
+        Returns the in memory state of the append log for key/name: the
+        manifest and the size and element count of the segment currently
+        being appended to. refresh reads it again from storage.
+        """
+        log = self.multipart_logs.get((key, name))
+        if log is not None and not refresh:
+            return log
+        manifest_name = "{}__{}".format(name, "manifest")
+        manifest = self.get(key, manifest_name, stype="json", refresh=refresh)
+        if manifest is None:
+            manifest = {
+                'format': 'jsonl',
+                'segment_bytes': self.multipart_segment_bytes,
+                'parts_index': 0,
+                'part_counts': []}
+            self._save_multipart_manifest(key, manifest_name, manifest)
+        elif manifest.get('format') != 'jsonl' or 'part_counts' not in manifest:
+            if manifest.get('format') != 'jsonl':
+                # Older manifests use json parts, start a new segment after them
+                manifest = {
+                    'format': 'jsonl',
+                    'segment_bytes': self.multipart_segment_bytes,
+                    'parts_index': manifest['parts_index'] + 1}
+            manifest['part_counts'] = self._multipart_part_counts(key, name, manifest)
+            self._save_multipart_manifest(key, manifest_name, manifest)
+        part_name = "{}__part{}".format(name, manifest['parts_index'])
+        log = {
+            'manifest_name': manifest_name,
+            'manifest': manifest,
+            'part_bytes': self.storage.size(key, part_name, 'jsonl') or 0,
+            'part_count': self._count_multipart_segment(key, part_name),
+            'manifest_mtime': self.storage.stat(key, manifest_name, 'json')[1]}
+        self.multipart_logs[(key, name)] = log
+        return log
+
+    def _multipart_log_current(self, key, name, log):
+        """True if no other process appended to or rolled over the log since we did."""
+        part_name = "{}__part{}".format(name, log['manifest']['parts_index'])
+        return (self.storage.stat(key, log['manifest_name'], 'json')[1] == log['manifest_mtime']
+                and (self.storage.size(key, part_name, 'jsonl') or 0) == log['part_bytes'])
+
+    def _save_multipart_manifest(self, key, manifest_name, manifest):
+        # Written synchronously so the manifest never points behind the segments on disk.
+        # This only happens when a segment rolls over.
+        self.save(key, name=manifest_name, value=manifest, stype="json", flush=False)
+        self._write(key, manifest, manifest_name, "json")
+
     def append_to_multipart_list(self,
                          key,
                          value: Any,
                          name="data"):
+        """
+        Appends value to a list stored as a sequence of jsonl segments. Each
+        append is a single file append, the manifest is only rewritten when
+        the current segment exceeds its size and a new one is started. With
+        read_only=True the values are only kept in memory, after the
+        stored ones.
+        """
+        key = format_key(key)
+        if is_ndarray(value):
+            value = value.item() if value.size == 1 else value.tolist()
+        if self.read_only:
+            self.multipart_appends.setdefault((key, name), []).append(value)
+            return
+        line = JSON_SERIALIZER.dumps(value, self.serializer_options) + b"\n"
+        if self.entry_locks is None:
+            self._append_to_multipart_log(key, name, line)
+            return
+        with self.entry_locks.lock(key, "{}__{}".format(name, "manifest")):
+            log = self.multipart_logs.get((key, name))
+            refresh = log is not None and not self._multipart_log_current(key, name, log)
+            self._append_to_multipart_log(key, name, line, refresh=refresh)
 
-        if type(value) is np.ndarray:
-            value = np.asscalar(value)
-        manifest_name = "{}__{}".format(name, "manifest")
+    def _append_to_multipart_log(self, key, name, line, refresh=False):
+        log = self._get_multipart_log(key, name, refresh=refresh)
+        manifest = log['manifest']
 
-        manifest = self.get(key, manifest_name, stype="json")
-        if manifest is None:
-            manifest = {}
-            manifest['chunksize'] = 500
-            manifest['parts_index'] = 0
-            self.save(key=key, name=manifest_name, value=manifest)
+        if log['part_bytes'] > 0 and log['part_bytes'] + len(line) > manifest['segment_bytes']:
+            manifest['part_counts'].append(log['part_count'])
+            manifest['parts_index'] += 1
+            self._save_multipart_manifest(key, log['manifest_name'], manifest)
+            log['manifest_mtime'] = self.storage.stat(key, log['manifest_name'], 'json')[1]
+            log['part_bytes'] = 0
+            log['part_count'] = 0
 
         part_name = "{}__part{}".format(name, manifest['parts_index'])
-        value_list = self.get(key=key, name=part_name)
-        if value_list is None:
-            value_list = []
-            self.save(key, name=part_name, value=value_list, stype='json')
+        self.storage.append(key, part_name, 'jsonl', line)
+        self.key_index.add(key, part_name, 'jsonl')
+        self.file_metadata.pop((key, part_name), None)
+        log['part_bytes'] += len(line)
+        log['part_count'] += 1
+
+    def append_rows(self, key, rows, name="data"):
+        """
+        Appends rows to the csv entry key/name in place, the existing rows
+        are not rewritten. Keeps the row index used by iter_rows current.
+        """
+        if self.read_only:
+            return
+        key = format_key(key)
+        data = CSV_SERIALIZER.dumps(rows, self.serializer_options)
+        # a save still in the queue would replace the appended rows
+        self.flush(key, name)
+        if self.entry_locks is None:
+            self._append_rows(key, name, data)
+        else:
+            with self.entry_locks.lock(key, name):
+                self._append_rows(key, name, data)
+
+    def _append_rows(self, key, name, data):
+        index = self._get_row_index(key, name)
+        self.storage.append(key, name, 'csv', data)
+        checkpoints = []
+        index['rows'], index['bytes'] = CSV_SERIALIZER.scan_rows(
+            io.BytesIO(data), index['rows'], index['bytes'], self.row_index_step, checkpoints)
+        index['mtime'] = self.storage.stat(key, name, 'csv')[1]
+        self._add_row_checkpoints(key, name, index, checkpoints)
+        self.data_store.pop(key, name)
+        self.file_metadata.pop((key, name), None)
+        self.key_index.add(key, str(name), 'csv')
+
+    def _get_row_index(self, key, name):
+        """
+        Returns the row index of a csv entry: the total rows and bytes and
+        a [row, offset] checkpoint every row_index_step rows. The checkpoints
+        are kept in name__rowindex.jsonl together with the mtime and size of
+        the file they were taken from. If the file changed since (rewritten
+        or appended to by another process) the index is built again.
+        """
+        mtime = self.storage.stat(key, name, 'csv')[1]
+        size = self.storage.size(key, name, 'csv') or 0
+        index = self.row_indexes.get((key, name))
+        if index is None:
+            index = self._load_row_index(key, name)
+        if index is not None and index['mtime'] == mtime and index['bytes'] == size:
+            self.row_indexes[(key, name)] = index
+            return index
+
+        if not self.read_only:
+            self._remove_row_index_file(key, name)
+        index = {'rows': 0, 'bytes': 0, 'mtime': mtime, 'row_numbers': [], 'offsets': []}
+        checkpoints = []
+        f = self.storage.open(key, name, 'csv')
+        if f is not None:
+            with f:
+                index['rows'], index['bytes'] = CSV_SERIALIZER.scan_rows(
+                    f, 0, 0, self.row_index_step, checkpoints)
+        self.row_indexes[(key, name)] = index
+        self._add_row_checkpoints(key, name, index, checkpoints)
+        return index
+
+    def _load_row_index(self, key, name):
+        f = self.storage.open(key, "{}__rowindex".format(name), 'jsonl')
+        if f is None:
+            return None
+        with f:
+            lines = [JSON_SERIALIZER.loads(line, self.serializer_options) for line in f]
+        # checkpoints are [row, offset] lists, each batch of them is followed
+        # by a {rows, bytes, mtime} line describing the indexed file
+        states = [line for line in lines if isinstance(line, dict)]
+        if not states:
+            return None
+        checkpoints = [line for line in lines if isinstance(line, list)]
+        return {
+            'rows': states[-1]['rows'],
+            'bytes': states[-1]['bytes'],
+            'mtime': states[-1]['mtime'],
+            'row_numbers': [c[0] for c in checkpoints],
+            'offsets': [c[1] for c in checkpoints]}
 
-        value_list.append(value)
+    def _add_row_checkpoints(self, key, name, index, checkpoints):
+        index['row_numbers'].extend(c[0] for c in checkpoints)
+        index['offsets'].extend(c[1] for c in checkpoints)
+        if self.read_only or index['mtime'] is None:
+            return
+        index_name = "{}__rowindex".format(name)
+        state = {'rows': index['rows'], 'bytes': index['bytes'], 'mtime': index['mtime']}
+        self.storage.append(key, index_name, 'jsonl', b"".join(
+            JSON_SERIALIZER.dumps(line, self.serializer_options) + b"\n"
+            for line in checkpoints + [state]))
+        self.file_metadata.pop((key, index_name), None)
+        self.key_index.add(key, index_name, 'jsonl')
 
-        is_full = len(value_list) >= manifest['chunksize']
-        self.save(key, name=part_name, value=value_list, stype='json')
+    def _remove_row_index_file(self, key, name):
+        index_name = "{}__rowindex".format(name)
+        self.storage.remove(key, index_name, 'jsonl')
+        self.key_index.remove(key, index_name)
+        self.file_metadata.pop((key, index_name), None)
 
-        if is_full:
-            manifest['parts_index'] += 1
-            new_part_name = "{}__part{}".format(name, manifest['parts_index'])
-            self.save(key=key, name=new_part_name, value=[], stype='json')
-            self.save(key=key, name=manifest_name, value=manifest)
+    def _drop_row_index(self, key, name):
+        # the rows were rewritten, their offsets are indexed again when needed
+        self.row_indexes.pop((key, name), None)
+        self._remove_row_index_file(key, name)
+
+    def iter_rows(self, key, name="data", start=0, stop=None):
+        """
+        Lazily yields rows start to stop (exclusive) of a csv entry. With
+        start > 0 reading begins at the closest indexed row before start,
+        so only up to row_index_step rows are skipped.
+        """
+        key = format_key(key)
+        if not self.read_only:
+            self.flush(key, name)
+        row, offset = 0, 0
+        if start > 0:
+            index = self._get_row_index(key, name)
+            i = bisect.bisect_right(index['row_numbers'], start) - 1
+            if i >= 0:
+                row, offset = index['row_numbers'][i], index['offsets'][i]
+        f = self.storage.open(key, name, 'csv')
+        if f is None:
+            return
+        f.seek(offset)
+        with io.TextIOWrapper(f, encoding='utf-8', newline='') as text:
+            for fields in CSV_SERIALIZER.reader(text):
+                if stop is not None and row >= stop:
+                    return
+                if row >= start:
+                    yield fields
+                row += 1
 
     def save(self, key, value, name='data', stype="json", clear_cache=False, last_updated=None, flush=True):
         key = format_key(key)
-        items = self.data_store.get(key, None)
-        if items is None:
-            items = {}
-            self.data_store[key] = items
-        items[name] = {
+        entry = {
             'key': key,
             'value': value,
             'name': name,
             'last_updated': last_updated, # file updated
             'stype': stype}
+        if flush and self.dict_delta_log and stype == "json" and self._has_dict_deltas(key, name):
+            # the patches would be applied on top of the new value, replace
+            # the file right away and drop them. A running compaction holds
+            # the lock until its older value is written.
+            with self.dict_delta_lock:
+                self.data_store.put(key, name, entry, dirty=True)
+                self.flush(key, name)
+                self._flush_sync(key, name, clear_cache)
+                self._drop_dict_deltas(key, name)
+            return
+        self.data_store.put(key, name, entry, dirty=flush)
         if flush:
             self._flush(key, name, clear_cache)
 
 
-    def list(self,key, use_cache=False):
-        #TODO: add list cache
-        key = format_key(key)
-        names = []
-        subkeys = []
-        path = self._get_path_from_key(key)
-        for fname in os.listdir(path):
-            if isfile(os.path.join(path, fname)):
-                name = os.path.splitext(fname)[0]
-                stype = os.path.splitext(fname)[1]
-                if name.endswith("_tmp"):
-                    continue
-                names.append(name)
-            else:
-                subkeys.append(fname)
-        return names, subkeys
+    def list(self, key, use_cache=None, prefix=None, offset=0, limit=None):
+        """
+        Returns the sorted entry names and sub keys of key. prefix, offset
+        and limit page through both lists. Answered from the key index
+        unless use_cache is False (defaults to the key_index setting), in
+        which case the key is rescanned and its index entry refreshed.
+        """
+        node = self._index_node(format_key(key), use_cache)
+        with self.key_index.lock:
+            return (KeyIndex.page(node.names, prefix, offset, limit),
+                    KeyIndex.page(node.subkeys, prefix, offset, limit))
+
+    def list_keys(self, key, use_cache=None, prefix=None, offset=0, limit=None):
+        """Returns a page of the sorted sub keys of key, see list."""
+        node = self._index_node(format_key(key), use_cache)
+        with self.key_index.lock:
+            return KeyIndex.page(node.subkeys, prefix, offset, limit)
+
+    def count(self, key, use_cache=None, prefix=None):
+        """Returns the number of entry names and sub keys of key starting with prefix."""
+        node = self._index_node(format_key(key), use_cache)
+        with self.key_index.lock:
+            return (len(KeyIndex.page(node.names, prefix)) if prefix else len(node.names),
+                    len(KeyIndex.page(node.subkeys, prefix)) if prefix else len(node.subkeys))
+
+    def rebuild_index(self):
+        """Drops the key index, keys are rescanned from storage when next listed."""
+        self.key_index.clear()
 
-    def list_keys_stream(self,key, use_cache=False):
-        #TODO: add list cache
+    def _index_node(self, key, use_cache=None):
+        if use_cache is None:
+            use_cache = self.use_key_index
+        return self.key_index.node(key, refresh=not use_cache)
+
+    def list_keys_stream(self, key, use_cache=None, page_size=1000):
         key = format_key(key)
-        path = self._get_path_from_key(key)
-        for fname in os.listdir(path):
-            if not isfile(os.path.join(path, fname)):
-                yield fname
+        offset = 0
+        while True:
+            subkeys = self.list_keys(key, use_cache=use_cache, offset=offset, limit=page_size)
+            yield from subkeys
+            if len(subkeys) < page_size:
+                return
+            offset += page_size
+            # only the first page rescans
+            use_cache = True
             
     def list_objects_with_name_stream(self,key,name):
         key = format_key(key)
@@ -286,11 +2592,9 @@ class DeadSimpleDB:
     def list_objects_with_name(self,key,name):
         key = format_key(key)
         names, subkeys = self.list(key)
-        print("Done listing")
+        results = self.get_many([(key + (col,), name) for col in subkeys])
         objects = []
-        for col in subkeys:
-            fullkey = key + (col,)
-            obj = self.get(fullkey,name)
+        for col, (obj, _) in zip(subkeys, results):
             if obj is not None:
                 objects.append((col,obj))
         return objects
@@ -299,32 +2603,163 @@ class DeadSimpleDB:
         key = format_key(key)
 
         names, subkeys = self.list(key)
+        # saved entries still waiting for the writer are not on disk yet
+        with self.data_store.lock:
+            queued = [name for name in self.data_store.names(key)
+                      if (key, name) in self.data_store.dirty and str(name) not in names]
+        names = names + queued
+        results = self.get_many([(key, name) for name in names])
         objects = []
-        for name in names:
-            obj = self.get(key,name)
+        for name, (obj, _) in zip(names, results):
             if obj is not None:
                 objects.append((name,obj))
         return objects
 
-    def get(self, key, name="data", stype=None, refresh=False):
-        key = format_key(key)
-        items = self.data_store.get(key, None)
+    def _get_io_pool(self):
+        if self.io_pool is None:
+            self.io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.io_threads)
+        return self.io_pool
+
+    def get_many(self, items, mmap=False):
+        """
+        Reads many entries at once. items are (key, name) or (key, name, stype)
+        tuples. Cached values are returned directly, the file types of the
+        other entries are resolved with one directory scan per key and the
+        files are read in parallel on io_threads threads.
+
+        Returns a list of (value, error) tuples in the order of items, value
+        is None for missing entries and error the exception raised reading
+        the entry.
+        """
+        requests = []
+        for item in items:
+            key = format_key(item[0])
+            name = item[1] if len(item) > 1 else "data"
+            stype = item[2] if len(item) > 2 else None
+            requests.append((key, name, stype))
+
+        results = [None] * len(requests)
+        pending = []
+        for i, (key, name, stype) in enumerate(requests):
+            entry = self.data_store.get(key, name)
+            if not self.check_file_last_updated and entry is not None and entry['value'] is not None:
+                self.data_store.record(hit=True)
+                results[i] = (entry['value'], None)
+            else:
+                pending.append(i)
+
+        # Resolve file types in bulk instead of probing every type per entry
+        unresolved: Dict[Tuple, List[int]] = {}
+        for i in pending:
+            key, name, stype = requests[i]
+            if stype is None:
+                entry = self.data_store.get(key, name)
+                if entry is not None and (entry['value'] is not None or (key, name) in self.data_store.dirty):
+                    # saved here, maybe not written yet, _get serves it from the cache
+                    requests[i] = (key, name, entry['stype'])
+                    continue
+            if stype is None and (key, name) not in self.file_metadata:
+                unresolved.setdefault(key, []).append(i)
+        for key, indexes in unresolved.items():
+            if len(indexes) < 8:
+                continue
+            stypes = self._index_node(key).stypes
+            for i in indexes:
+                _, name, _ = requests[i]
+                stype = stypes.get(str(name))
+                if stype is not None:
+                    # names not in the scan are probed by _get as usual
+                    requests[i] = (key, name, stype)
+
+        def read(i):
+            key, name, stype = requests[i]
+            try:
+                return self._get(key, name, stype=stype, mmap=mmap, raise_errors=True), None
+            except Exception as e:
+                return None, e
+
+        if len(pending) == 1:
+            results[pending[0]] = read(pending[0])
+        elif pending:
+            for i, result in zip(pending, self._get_io_pool().map(read, pending)):
+                results[i] = result
+        return results
+
+    def save_many(self, items, clear_cache=False):
+        """
+        Saves many entries at once. items are (key, value), (key, value, name)
+        or (key, value, name, stype) tuples. With the write thread the writes
+        are queued as usual, otherwise the files are written in parallel on
+        io_threads threads. When an entry appears more than once the last
+        value wins.
+
+        Returns a list with None or the exception raised for each item.
+        """
+        errors = [None] * len(items)
+        latest = OrderedDict()
+        for i, item in enumerate(items):
+            key = format_key(item[0])
+            name = item[2] if len(item) > 2 else "data"
+            stype = item[3] if len(item) > 3 else "json"
+            try:
+                if self.use_write_thread or self.read_only:
+                    self.save(key, item[1], name=name, stype=stype, clear_cache=clear_cache)
+                else:
+                    with self.data_store.lock:
+                        self.save(key, item[1], name=name, stype=stype, flush=False)
+                        self.data_store.mark_dirty(key, name)
+                    latest.pop((key, name), None)
+                    latest[(key, name)] = (i, stype)
+            except Exception as e:
+                errors[i] = e
+
+        def write(key_name):
+            key, name = key_name
+            try:
+                self._flush_sync_replacing(key, name, latest[key_name][1], clear_cache)
+            except Exception as e:
+                return e
+
+        if latest:
+            for (i, _), error in zip(latest.values(), self._get_io_pool().map(write, latest.keys())):
+                errors[i] = error
+        return errors
+
+    def get(self, key, name="data", stype=None, refresh=False, mmap=False):
+        """
+        Returns the value stored for key/name or None. With mmap=True npy
+        arrays read from disk are memory mapped read only instead of loaded,
+        so they open in constant time and share pages between processes.
+        """
+        if self.metrics is None:
+            return self._get(format_key(key), name, stype=stype, refresh=refresh, mmap=mmap)
+        start = time.perf_counter()
+        value = self._get(format_key(key), name, stype=stype, refresh=refresh, mmap=mmap)
+        self.metrics.observe("get", time.perf_counter() - start, key=key, name=name, hit=value is not None)
+        return value
+
+    def _get(self, key, name="data", stype=None, refresh=False, mmap=False, raise_errors=False):
+        entry = self.data_store.get(key, name)
+        # resolved once and handed to _read, so a get probes the storage once
+        meta = None
         if self.check_file_last_updated:
-            file_last_updated = self._file_last_updated( key, name=name, stype=stype)
+            meta = self._file_metadata(key, name, stype)
+            file_last_updated = self._file_last_updated(key, name=name, meta=meta)
         else:
             file_last_updated = None
 
-        if not refresh and items is not None and name in items:
-            entry = items.get(name)
+        if not refresh and entry is not None:
             cached_last_updated = entry.get('last_updated',None)
             # Return data from cache if ...
             if file_last_updated is None or cached_last_updated is None or file_last_updated <= cached_last_updated:
                 data = entry.get('value')
                 if data is not None:
+                    self.data_store.record(hit=True)
                     return data
-        
+        self.data_store.record(hit=False)
+
         # read data from file
-        data, stype = self._read(key, name, stype)
+        data, stype = self._read(key, name, stype, mmap=mmap, raise_errors=raise_errors, meta=meta)
         if data is None:
             return None
         self.save(key, data, 
@@ -335,64 +2770,163 @@ class DeadSimpleDB:
         return data
 
     def delete(self, key, name="data", stype=None):
-        #TODO Fix slow deletes
+        """
+        Deletes key/name, a pending write of the entry is dropped instead
+        of being written first. With name=None only an empty key is removed.
+        """
         key = format_key(key)
-        self.flush_all()
-        items = self.data_store.get(key)
-        path = self._get_path_from_key(key)
+        if name is None:
+            self._remove_empty_keys([key])
+        else:
+            self.delete_many([(key, name, stype)])
 
-        #Remove file from disk
-        if name is not None:
-            items.pop(name,None)
-            filepath_prefix = os.path.join(path, "{}".format(name))
-            if stype is None:
-                stype = get_filetype(filepath_prefix)
-                    
-                    #raise Exception("Not found")
-            if stype is not None:
-                filepath = os.path.join(path, "{}.{}".format(name, stype.lower()))
-                if os.path.isfile(filepath):
-                    os.remove(filepath)
-            
-        #Remove path
-        if items is None or len(items) == 0:
-            # Remove Path From memory
-            self.data_store.pop(key,None)
+    def delete_many(self, items):
+        """
+        Deletes many entries at once. items are (key, name) or
+        (key, name, stype) tuples. Pending writes of the entries are dropped,
+        the file types are resolved with one scan per key and keys left
+        empty are removed.
+        """
+        if self.read_only:
+            return
+        requests = []
+        for item in items:
+            key = format_key(item[0])
+            name = item[1] if len(item) > 1 else "data"
+            stype = item[2] if len(item) > 2 else None
+            requests.append((key, name, stype))
+            if self.dict_delta_log:
+                requests.extend((key, delta_name, 'jsonl') for delta_name in self._dict_delta_names(name))
+                self.dict_delta_sizes.pop((key, name), None)
+        if not requests:
+            return
+        if self.use_write_thread:
+            targets = {(key, name) for key, name, _ in requests}
+            self.write_queue.cancel(lambda key, name: (key, name) in targets)
 
-            # If path is empty
-            if len(os.listdir(path)) == 0:
-                try:
-                    if not os.path.isfile(path):
-                        os.rmdir(path=os.path.join(os.getcwd(),path))
-                except Exception as e:
-                    print(e)
-                if len(key) > 1:
-                    self.delete(key[:-1],name=None)
+        # known file types come from the metadata cache, a key with many
+        # unknown ones is scanned once instead of probing every file type
+        unresolved: Dict[Tuple, int] = {}
+        for i, (key, name, stype) in enumerate(requests):
+            meta = self.file_metadata.get((key, name))
+            if stype is None and meta is not None and meta[0] is not None:
+                requests[i] = (key, name, meta[0])
+            elif stype is None:
+                unresolved[key] = unresolved.get(key, 0) + 1
+        scanned = {key: self.key_index.node(key, refresh=True).stypes
+                   for key, count in unresolved.items() if count >= 8}
 
-    def prepvalue(self,value):
-        return value
+        for key, name, stype in requests:
+            self.data_store.pop(key, name)
+            if stype is None and key in scanned:
+                stype = scanned[key].get(str(name))
+                if stype is not None:
+                    self.storage.remove(key, name, stype)
+            else:
+                self.storage.remove(key, name, stype)
+            self.key_index.remove(key, str(name))
+            self.file_metadata.pop((key, name), None)
+        self._remove_empty_keys({key for key, _, _ in requests})
+
+    def delete_prefix(self, key):
+        """
+        Deletes key with all entries and keys below it in one pass. Pending
+        writes below key are dropped and the cache is purged.
+        """
+        if self.read_only:
+            return
+        key = format_key(key)
+        if self.use_write_thread:
+            self.write_queue.cancel(lambda entry_key, name: entry_key[:len(key)] == key)
+        self.data_store.pop_prefix(key)
+        self.storage.remove_tree(key)
+        for key_name in [k for k in self.dict_delta_sizes if k[0][:len(key)] == key]:
+            self.dict_delta_sizes.pop(key_name, None)
+        self.key_index.remove_tree(key)
+        for cache in (self.file_metadata, self.multipart_logs):
+            for key_name in [k for k in cache if k[0][:len(key)] == key]:
+                cache.pop(key_name, None)
+        if len(key) > 1:
+            self._remove_empty_keys([key[:-1]])
+
+    def _remove_empty_keys(self, keys):
+        """Removes the keys without entries, walking up to their parents."""
+        keys = set(keys)
+        while keys:
+            # deepest keys first so parents are only checked once emptied
+            depth = max(len(key) for key in keys)
+            level = [key for key in keys if len(key) == depth]
+            keys.difference_update(level)
+            for key in level:
+                if len(self.data_store.names(key)) == 0 and self.storage.remove_key_if_empty(key):
+                    self.key_index.remove_key(key)
+                    if len(key) > 1:
+                        keys.add(key[:-1])
+
+    def prepvalue(self, value, stype="json"):
+        """
+        Returns what is queued for writing value, see the snapshot option.
+        """
+        if self.snapshot == "none":
+            return value
+        if self.snapshot == "copy":
+            return snapshot_copy(value)
+        if self.snapshot == "deepcopy":
+            return copy.deepcopy(value)
+        return EncodedValue(encode_value(value, stype, self.serializer_options))
 
     def _flush(self, key, name='data', clear_cache=False):
+        if self.metrics is not None:
+            start = time.perf_counter()
+            result = self._enqueue(key, name, clear_cache)
+            self.metrics.observe("flush", time.perf_counter() - start, key=key, name=name)
+            return result
+        return self._enqueue(key, name, clear_cache)
+
+    def _enqueue(self, key, name='data', clear_cache=False):
         if self.read_only:
             return "not flushing {} {}".format(key,name)
         elif self.use_write_thread:
             # self._write_to_q((key,name,clear_cache))
             if self.read_only:
                 return 
-            items = self.data_store[key]
-            entry = items.get(name)
-            if entry is not None:
-                value = entry['value']
+            # callers mark the entry dirty before flushing it so it can not be
+            # evicted, it is only missing when it was deleted meanwhile
+            entry = self.data_store.get(key, name)
+            if entry is None:
+                return
+            value = entry['value']
+            # measured by the cache when the value was saved
+            size = entry['size']
+            version = self.data_store.mark_dirty(key, name)
             if clear_cache:
-                entry['value'] = None
+                self.data_store.drop_value(key, name)
             # self._write(key, name=name, value=value, stype=entry['stype'])
-            self.write_queue.put((key,name,self.prepvalue(value),entry['stype']))
+            value = self.prepvalue(value, entry['stype'])
+            if type(value) is EncodedValue:
+                size = None
+            if self.writer_threads is None:
+                self._start_writers()
+            if not self.write_queue.put((key, name, value, entry['stype']), version, size):
+                # queue full, write on the calling thread
+                if type(value) is EncodedValue:
+                    self._write_bytes(key, name, entry['stype'], value.data)
+                else:
+                    self._write(key, value, name, entry['stype'])
+                self.data_store.mark_clean(key, name, version)
         else:
             self._flush_sync(key,name,clear_cache)
 
     def delayed_write(self,key,name,value,stype):
         if self.use_write_thread:
-            self.write_queue.put((key,name,self.prepvalue(value),stype))
+            value = self.prepvalue(value, stype)
+            if self.writer_threads is None:
+                self._start_writers()
+            if not self.write_queue.put((key, name, value, stype)):
+                if type(value) is EncodedValue:
+                    self._write_bytes(key, name, stype, value.data)
+                else:
+                    self._write(key, value, name, stype)
         else:
             raise Exception("Delayed write not supported with use_write_thread=False")
 
@@ -400,57 +2934,110 @@ class DeadSimpleDB:
         key,name,stype = path_to_key_name_stype(self.root_path, path)
         self.delayed_write(key,name,value,stype)
 
+    def check_path(self, path):
+        """Creates the directory path if it does not exist."""
+        if isinstance(self.storage, FileStorage):
+            self.storage.check_path(path)
+        else:
+            os.makedirs(path, exist_ok=True)
+
+    def _get_path_from_key(self, key):
+        """Returns the directory of key under root_path, creating it if needed."""
+        key = key if type(key) is tuple else (key,)
+        if isinstance(self.storage, FileStorage):
+            return self.storage.path(key, create=True)
+        path = os.path.join(*[str(k) for k in [self.root_path] + list(key)])
+        self.check_path(path)
+        return path
+
     def _flush_sync(self, key, name='data', clear_cache=False):
         if self.read_only:
             return 
-        items = self.data_store[key]
-        entry = items.get(name)
+        entry = self.data_store.get(key, name)
         if entry is not None:
             value = entry['value']
+            version = self.data_store.mark_dirty(key, name)
             if clear_cache:
-                entry['value'] = None
+                self.data_store.drop_value(key, name)
             self._write(key, name=name, value=value, stype=entry['stype'])
+            self.data_store.mark_clean(key, name, version)
 
-    async def _flush_async(self, key, name='data', clear_cache=False):
-        if self.read_only:
-            return 
-        items = self.data_store[key]
-        entry = items.get(name)
-        if entry is not None:
-            value = entry['value']
-            if clear_cache:
-                entry['value'] = None
-            self._write(key, name=name, value=value, stype=entry['stype'])         
-
-    def _get_path_from_key(self, key):
-        if type(key) is tuple:
-            path_parts = [str(k) for k in [self.root_path] + list(key)]
-        else:
-            path_parts = [str(k) for k in [self.root_path] + [key]]
-        path = os.path.join(*path_parts)
-        self.check_path(path)
-        return path
-        
     def close(self):
+        if self.close_at_exit is not None:
+            atexit.unregister(self.close_at_exit)
+            self.close_at_exit = None
+        if self.io_pool is not None:
+            self.io_pool.shutdown()
+            self.io_pool = None
+        if not self.read_only and self.use_write_thread:
+            self.write_queue.close()
+            for writer_thread in self.writer_threads or []:
+                writer_thread.join()
+            if self.encode_pool is not None:
+                self.encode_pool.shutdown()
+        if self.entry_locks is not None:
+            self.entry_locks.close()
+        self.storage.close()
+
+    def export(self, dest_root, storage="files"):
+        """
+        Copies all entries to a new database at dest_root using storage,
+        eg. to turn a packed database into the per file layout.
+        """
+        self.flush_all()
+        dest = STORAGES[storage](dest_root)
+        try:
+            for key, name, stype, data in self.storage.entries():
+                dest.write(key, name, stype, data)
+        finally:
+            dest.close()
+
+    def cache_stats(self):
+        """Returns entry count, approximate bytes and hit/miss/eviction counters of the cache."""
+        return self.data_store.stats()
+
+    def queue_depth(self):
+        """Number of entries waiting to be written or being written."""
+        return self.write_queue.qsize() if self.use_write_thread else 0
+
+    def stats(self):
+        """
+        Returns the cache and write queue state, plus counters and latency
+        summaries (seconds) per operation when metrics are enabled: get,
+        read, encode, write, commit, flush (the time save spends queueing)
+        and queue_wait (time from save until the writer picks a value up).
+        """
+        stats = {
+            'cache': self.data_store.stats(),
+            'queue': self.write_queue.stats() if self.use_write_thread else {},
+            'queue_depth': self.queue_depth(),
+            'counters': {},
+            'latency': {}}
+        if self.metrics is not None:
+            stats.update(self.metrics.stats())
+        return stats
+
+    def flush_all(self, timeout=None):
+        """
+        Blocks until everything saved before the call is written. Returns
+        False if timeout seconds passed first.
+        """
         if self.read_only:
-            return 
+            return True
         if self.use_write_thread:
-            self.writer_thread.running = False
-            self.writer_thread.join()
-        else:
-            return
+            return self.write_queue.flush(timeout=timeout)
+        return True
 
-    def flush_all(self):
+    def flush(self, key, name='data', timeout=None):
+        """
+        Blocks until the changes to key/name saved before the call are
+        written. Returns False if timeout seconds passed first.
+        """
         if self.read_only:
-            return 
+            return True
         if self.use_write_thread:
-            flushed = False
-            while not flushed:
-                if self.write_queue.qsize() == 0:
-                    return
-            self.writer_thread.join()
-        else:
-            return
+            return self.write_queue.flush_entry(format_key(key), name, timeout=timeout)
+        return True
                     
     def _write(self, key, value, name='data', stype="json"):
         """
@@ -460,82 +3047,215 @@ class DeadSimpleDB:
         if self.read_only:
             return
 
-        path = self._get_path_from_key(key)
-        filepath = os.path.join(path, "{}.{}".format(name, stype.lower()))
-        filepath_tmp = os.path.join(
-            path, "{}_tmp.{}".format(name, stype.lower()))
         try:
-            if stype == "json":
-                with open(filepath_tmp, 'w') as f:
-                    json.dump(value, f, ignore_nan=True, cls=self.json_encoder)
-            elif stype == "pkl":
-                with open(filepath_tmp, 'wb') as f:
-                    pickle.dump(value, f)
-            elif stype == "png" or stype == "jpg":
-                    if type(value) == np.ndarray:
-                        im = PIL.Image.fromarray(value)
-                    else:
-                        im = value
-                    im.save(filepath_tmp)
-            elif stype == "csv":
-                with open(filepath_tmp, 'w') as f:
-                    writer = csv.writer(f, delimiter='\t',
-                                            quotechar='|', 
-                                            quoting=csv.QUOTE_MINIMAL)
-                    writer.writerows(value)
+            if self.metrics is None:
+                data = encode_value(value, stype, self.serializer_options)
             else:
-                with open(filepath_tmp, 'w') as f:
-                    f.write(value)
-            shutil.copyfile(filepath_tmp, filepath)
-            os.remove(filepath_tmp)
+                start = time.perf_counter()
+                data = encode_value(value, stype, self.serializer_options)
+                self.metrics.observe("encode", time.perf_counter() - start,
+                                     key=key, name=name, stype=stype, bytes=len(data))
+            self._write_bytes(key, name, stype, data)
         except Exception as e:
-            print("Error key:{} name:{} type:{}".format(key,name,type(value)))
-            print("\t{}".format(value))
+            logging.error("Error key:{} name:{} type:{}".format(key,name,type(value)))
             raise e
 
+    def _write_bytes(self, key, name, stype, data):
+        """
+        writes already encoded data to the storage for key/name
+        """
+        if self.metrics is None:
+            mtime = self.storage.write(key, name, stype, data, getattr(self.write_local, 'group', None))
+        else:
+            start = time.perf_counter()
+            mtime = self.storage.write(key, name, stype, data, getattr(self.write_local, 'group', None))
+            self.metrics.observe("write", time.perf_counter() - start,
+                                 key=key, name=name, stype=stype, bytes=len(data))
+            self.metrics.count("bytes_written.{}".format(stype), len(data))
+        if mtime is not None:
+            self.file_metadata[(key, name)] = (stype, mtime, time.time())
+            self.key_index.add(key, str(name), stype)
+            if stype == 'csv':
+                self._drop_row_index(key, name)
+            if self.multi_process:
+                self._set_last_updated(key, name, mtime)
 
-    def _file_last_updated(self, key, name="data", stype=None):
-        path = self._get_path_from_key(key)
-        filepath_prefix = os.path.join(path, "{}".format(name))
-        if stype is None:
-            stype = get_filetype(filepath_prefix)
-            if stype is None:
-                return None
-        filepath = filepath_prefix + "." + stype.lower()
+    def _set_last_updated(self, key, name, mtime):
+        # lets get tell later writes of other processes from our own
+        with self.data_store.lock:
+            entry = self.data_store.entries.get((key, name))
+            if entry is not None:
+                entry['last_updated'] = mtime
 
-        if os.path.isfile(filepath):
-            return os.path.getmtime(filepath)
-        else:
-            return None
+    def _commit_group(self, group):
+        """
+        commits the writes collected by a writer thread at once
+        """
+        start = time.perf_counter()
+        committed = self.storage.commit(group)
+        if self.metrics is not None:
+            self.metrics.observe("commit", time.perf_counter() - start, entries=len(committed))
+        for key, name, stype, mtime in committed:
+            self.file_metadata[(key, name)] = (stype, mtime, time.time())
+            self.key_index.add(key, str(name), stype)
+            if stype == 'csv':
+                self._drop_row_index(key, name)
+            if self.multi_process:
+                self._set_last_updated(key, name, mtime)
+
+    def _file_metadata(self, key, name="data", stype=None):
+        """
+        Returns (stype, mtime) of the stored entry for key/name. stype is
+        None if no entry exists, mtime is None if the entry for the
+        requested stype does not exist.
 
-    def _read(self, key, name="data", stype=None, default_value=None):
-        path = self._get_path_from_key(key)
-        filepath_prefix = os.path.join(path, "{}".format(name))
+        Results are cached and updated by our own writes. Cached results
+        younger than metadata_ttl seconds are used without touching the
+        storage, metadata_ttl=None trusts them forever. Otherwise a known
+        entry is checked with a single stat instead of probing every file type.
+        """
+        meta = self.file_metadata.get((key, name))
+        if meta is not None and (stype is None or meta[0] == stype):
+            if self.metadata_ttl is None or time.time() - meta[2] < self.metadata_ttl:
+                return meta[:2]
+            if meta[0] is not None:
+                _, mtime = self.storage.stat(key, name, meta[0])
+                if mtime is not None:
+                    self.file_metadata[(key, name)] = (meta[0], mtime, time.time())
+                    return meta[0], mtime
+
+        requested_stype = stype
+        stype, mtime = self.storage.stat(key, name, stype)
+        if requested_stype is None or mtime is not None:
+            self.file_metadata[(key, name)] = (stype if mtime is not None else None, mtime, time.time())
+        return stype, mtime
+
+    def _file_last_updated(self, key, name="data", stype=None, meta=None):
+        stype, mtime = meta if meta is not None else self._file_metadata(key, name, stype)
+        if self.dict_delta_log and stype == "json" and mtime is not None:
+            # patches change the value without touching the json file
+            for delta_name in self._dict_delta_names(name):
+                delta_mtime = self._file_metadata(key, delta_name, 'jsonl')[1]
+                if delta_mtime is not None and delta_mtime > mtime:
+                    mtime = delta_mtime
+        return mtime
+
+    def _read(self, key, name="data", stype=None, default_value=None, mmap=False, raise_errors=False, meta=None):
+        """
+        Reads key/name from storage, returns (value, stype). meta is the
+        (stype, mtime) already resolved by _file_metadata, if any.
+        """
+        stype, mtime = meta if meta is not None else self._file_metadata(key, name, stype)
         if stype is None:
-            stype = get_filetype(filepath_prefix)
-            if stype is None:
-                return None, None
-        filepath = filepath_prefix + "." + stype.lower()
+            return None, None
         try:
-            if not os.path.isfile(filepath):
+            if mtime is None:
                 return default_value, stype
 
-            if stype.lower() == "json":
-                with open(filepath, 'r') as f:
-                    value = json.load(f, cls=self.json_decoder)
-            elif stype == "pkl":
-                with open(filepath, 'rb') as f:
-                    value = pickle.load(f)
-            elif stype == "csv":
-                value = []
-                with open(filepath, 'r') as f:
-                    reader = csv.reader(f, delimiter='\t', quotechar='|')
-                    for line in reader:
-                        value.append(line)
-            else:
+            serializer = get_serializer(stype)
+            if serializer is None:
                 raise Exception("Unsupported format {}".format(stype))
+            if self.metrics is None:
+                value = self.storage.load(key, name, stype, serializer, self.serializer_options, mmap=mmap)
+            else:
+                start = time.perf_counter()
+                value = self.storage.load(key, name, stype, serializer, self.serializer_options, mmap=mmap)
+                self.metrics.observe("read", time.perf_counter() - start, key=key, name=name, stype=stype)
+            if self.dict_delta_log and stype == "json" and type(value) is dict:
+                value = self._apply_dict_deltas(key, name, value)
         except Exception as e:
-            print("Error reading key:{}, name:{}, stype:{}".format(key,name,stype))
-            print("Exception = {}".format(e))
+            if self.metrics is not None:
+                self.metrics.count("read_errors")
+            if raise_errors:
+                raise
+            logging.error("Error reading key:{}, name:{}, stype:{} --- {}".format(key,name,stype,e))
             return None,None
         return value, stype
+
+
+class AsyncDeadSimpleDB:
+    """
+    asyncio front end for DeadSimpleDB. Takes the same arguments, or an
+    existing instance with db=. File I/O runs in executor (the default loop
+    executor if None) so the event loop never blocks on the disk. Concurrent
+    gets of the same entry share a single read.
+    """
+
+    def __init__(self, *args, db=None, executor=None, **kwargs):
+        self.db = db if db is not None else DeadSimpleDB(*args, **kwargs)
+        self.executor = executor
+        self.pending_reads: Dict[Tuple, "asyncio.Future"] = {}
+
+    async def _run(self, func, *args, **kwargs):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def get(self, key, name="data", stype=None, refresh=False, mmap=False):
+        import asyncio
+        key = format_key(key)
+        read_key = (key, name, stype, refresh, mmap)
+        future = self.pending_reads.get(read_key)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._run(self.db.get, key, name=name, stype=stype, refresh=refresh, mmap=mmap))
+            self.pending_reads[read_key] = future
+            future.add_done_callback(lambda _: self.pending_reads.pop(read_key, None))
+        # shielded so a cancelled awaiter does not cancel the read for the others
+        return await asyncio.shield(future)
+
+    async def get_many(self, items, mmap=False):
+        return await self._run(self.db.get_many, items, mmap=mmap)
+
+    def _save_queues_only(self, stype):
+        """
+        True if db.save only updates the cache and queues the write, so it
+        can run on the event loop. A bounded queue may block or write on
+        the calling thread, serialize snapshots encode and patched dicts and
+        csv row indexes touch the disk.
+        """
+        db = self.db
+        if db.read_only:
+            return True
+        if not db.use_write_thread:
+            return False
+        bounded = any(shard.max_items is not None or shard.max_bytes is not None
+                      for shard in db.write_queue.shards)
+        return (not bounded and db.snapshot != "serialize" and stype != "csv"
+                and not (db.dict_delta_log and stype == "json"))
+
+    async def save(self, key, value, name='data', stype="json", clear_cache=False):
+        if self._save_queues_only(stype):
+            self.db.save(key, value, name=name, stype=stype, clear_cache=clear_cache)
+        else:
+            await self._run(self.db.save, key, value, name=name, stype=stype, clear_cache=clear_cache)
+
+    async def save_many(self, items, clear_cache=False):
+        return await self._run(self.db.save_many, items, clear_cache=clear_cache)
+
+    async def update_dict(self, key, value, name='data', stype="json", clear_cache=False):
+        await self._run(self.db.update_dict, key, value, name=name, stype=stype, clear_cache=clear_cache)
+
+    async def append_to_list(self, key, value, name='data', stype="json", clear_cache=False):
+        await self._run(self.db.append_to_list, key, value, name=name, stype=stype, clear_cache=clear_cache)
+
+    async def list(self, key, **kwargs):
+        return await self._run(self.db.list, key, **kwargs)
+
+    async def count(self, key, **kwargs):
+        return await self._run(self.db.count, key, **kwargs)
+
+    async def list_objects(self, key):
+        return await self._run(self.db.list_objects, key)
+
+    async def delete(self, key, name="data", stype=None):
+        await self._run(self.db.delete, key, name=name, stype=stype)
+
+    async def flush_all(self, timeout=None):
+        return await self._run(self.db.flush_all, timeout=timeout)
+
+    async def flush(self, key, name='data', timeout=None):
+        return await self._run(self.db.flush, key, name=name, timeout=timeout)
+
+    async def close(self):
+        await self._run(self.db.close)
@@ -20,5 +20,11 @@ setuptools.setup(
     ],
     license='MIT',
     install_requires=['simplejson>=3.17.0',],
+    extras_require={
+        'orjson': ['orjson'],
+        'msgpack': ['msgpack'],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+    },
     python_requires='>=3.7',
 )
\ No newline at end of file
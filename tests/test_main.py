@@ -2,6 +2,12 @@ import numpy
 from deadsimpledb import DeadSimpleDB, format_key
 import unittest
 import time
+import os
+from unittest import mock
+import importlib.util
+
+OPTIONAL_CODECS = all(importlib.util.find_spec(m) is not None
+                      for m in ['orjson', 'msgpack', 'zstandard', 'lz4'])
 
 class TestMain(unittest.TestCase):
 
@@ -13,6 +19,8 @@ class TestMain(unittest.TestCase):
         dsdb.save(key, value=value)
         value2 = dsdb.get(key)
         assert(value['value'] == value2['value'])
+        assert(dsdb._get_path_from_key(key) == os.path.join("/tmp/testdb", "entry", "1"))
+        assert(os.path.isdir(dsdb._get_path_from_key(key)))
 
     def test_multiple_key(self):
 
@@ -35,28 +43,7 @@ class TestMain(unittest.TestCase):
             use_write_thread=False,
             read_only=False)
         self.multiwrite('sync',dsdb,size)
-
-        """
-        mem_only
-Runtime:1.4291698932647705
-Full Write time:1.4292702674865723
-Using Write Thread
----
-with_thread
-Runtime:2.2632408142089844
-Full Write time:42.657451152801514
-Not using write thread
----
-sync
-Runtime:26.0583233833313
-Full Write time:26.05849027633667
-
-        """
-
-
-
-
-
+        # timings of these modes are tracked by benchmarks/bench_db.py
 
     def multiwrite(self,prefix,dsdb,size):
 
@@ -157,3 +144,784 @@ Full Write time:26.05849027633667
         print("item count {}".format(item_count))
 
         assert(item_count == 10)
+
+
+    def test_coalesced_writes(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_coalesce", overwrite=True, max_write_latency=60)
+        writes = []
+        write = dsdb._write
+        def counting_write(key, value, name='data', stype='json'):
+            writes.append((key, name))
+            write(key, value, name, stype)
+        dsdb._write = counting_write
+
+        key = ("coalesce", 1)
+        for i in range(1000):
+            dsdb.append_to_list(key, name="log", value=i)
+        dsdb.flush_all()
+
+        assert(len(writes) == 1)
+        dsdb = DeadSimpleDB("/tmp/testdb_coalesce")
+        assert(dsdb.get(key, name="log") == list(range(1000)))
+
+    def test_writer_pool(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_pool", overwrite=True,
+                            writer_threads=3, encode_processes=2)
+        for i in range(30):
+            dsdb.save(("pool", i), value={'value': i})
+            dsdb.save(("pool", i), name="arr", value=numpy.ones((2, 2)) * i, stype='pkl')
+        dsdb.close()
+
+        dsdb = DeadSimpleDB("/tmp/testdb_pool")
+        for i in range(30):
+            assert(dsdb.get(("pool", i))['value'] == i)
+            assert(dsdb.get(("pool", i), name="arr")[0, 0] == i)
+
+        # a broken pool is replaced by encoding on the writer thread
+        dsdb = DeadSimpleDB("/tmp/testdb_pool", overwrite=True, encode_processes=1)
+        image = numpy.zeros((4, 4), dtype=numpy.uint8)
+        dsdb.save("img", value=image, stype="png")
+        assert(dsdb.flush_all(timeout=10))
+        for process in list(dsdb.encode_pool._processes.values()):
+            process.kill()
+            process.join()
+        for i in range(3):
+            dsdb.save(("img", i), value=image + i, stype="png")
+            dsdb.save(("json", i), value={'value': i})
+        assert(dsdb.flush_all(timeout=10))
+        assert(all(thread.is_alive() for thread in dsdb.writer_threads))
+        dsdb.close()
+        dsdb = DeadSimpleDB("/tmp/testdb_pool", read_only=True)
+        assert(numpy.asarray(dsdb.get(("img", 2)))[0, 0] == 2)
+        assert(dsdb.get(("json", 2)) == {'value': 2})
+
+    def test_multipart_list(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_multipart", overwrite=True,
+                            multipart_segment_bytes=64)
+        key = ("multipart", 1)
+        for i in range(50):
+            dsdb.append_to_multipart_list(key, value={'v': i}, name="log")
+        dsdb.flush_all()
+
+        manifest = dsdb.get(key, name="log__manifest")
+        assert(manifest['parts_index'] > 0)
+        assert([v['v'] for v in dsdb.get_multipart_list(key, name="log")] == list(range(50)))
+
+        dsdb = DeadSimpleDB("/tmp/testdb_multipart", multipart_segment_bytes=64)
+        for i in range(50, 60):
+            dsdb.append_to_multipart_list(key, value={'v': i}, name="log")
+        assert([v['v'] for v in dsdb.get_multipart_list(key, name="log")] == list(range(60)))
+        first_part = dsdb.get_multipart_list(key, name="log", start_idx=0, end_idx=1)
+        assert(0 < len(first_part) < 60)
+        assert([v['v'] for v in first_part] == list(range(len(first_part))))
+
+    def test_iter_multipart_list(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_multipart_iter", overwrite=True,
+                            multipart_segment_bytes=64)
+        key = ("multipart", 2)
+        for i in range(100):
+            dsdb.append_to_multipart_list(key, value=i, name="log")
+        dsdb.flush_all()
+
+        dsdb = DeadSimpleDB("/tmp/testdb_multipart_iter")
+        assert(list(dsdb.iter_multipart_list(key, name="log")) == list(range(100)))
+        assert(list(dsdb.iter_multipart_list(key, name="log", offset=37, limit=20)) == list(range(37, 57)))
+        assert(list(dsdb.iter_multipart_list(key, name="log", tail=15)) == list(range(85, 100)))
+        assert(list(dsdb.iter_multipart_list(key, name="log", tail=500)) == list(range(100)))
+        assert(list(dsdb.iter_multipart_list(key, name="missing")) == [])
+
+        # read only appends are kept in memory after the stored values
+        reader = DeadSimpleDB("/tmp/testdb_multipart_iter", read_only=True)
+        for i in range(100, 110):
+            reader.append_to_multipart_list(key, value=i, name="log")
+            reader.append_to_multipart_list(key, value=i, name="new")
+        assert(reader.get_multipart_list(key, name="log") == list(range(110)))
+        assert(reader.get_multipart_list(key, name="new") == list(range(100, 110)))
+        assert(list(reader.iter_multipart_list(key, name="log", offset=95, limit=10)) == list(range(95, 105)))
+        assert(list(reader.iter_multipart_list(key, name="log", tail=15)) == list(range(95, 110)))
+        assert(list(reader.iter_multipart_list(key, name="new", offset=3, limit=2)) == [103, 104])
+        assert(list(DeadSimpleDB("/tmp/testdb_multipart_iter").iter_multipart_list(key, name="log")) == list(range(100)))
+
+    def test_bounded_cache(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_cache", overwrite=True,
+                            use_write_thread=False, cache_max_entries=5)
+        for i in range(20):
+            dsdb.save(("cache", i), value={'value': i})
+        stats = dsdb.cache_stats()
+        assert(stats['entries'] == 5)
+        assert(stats['evictions'] == 15)
+        assert(dsdb.get(("cache", 0))['value'] == 0)
+        assert(dsdb.cache_stats()['misses'] == 1)
+        assert(dsdb.get(("cache", 0))['value'] == 0)
+        assert(dsdb.cache_stats()['hits'] == 1)
+
+    def test_bounded_cache_keeps_dirty(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_cache_dirty", overwrite=True,
+                            max_write_latency=60, cache_max_entries=5)
+        for i in range(20):
+            dsdb.save(("cache", i), value={'value': i})
+        assert(dsdb.cache_stats()['entries'] == 20)
+        dsdb.flush_all()
+        dsdb.save(("cache", 20), value={'value': 20})
+        assert(dsdb.cache_stats()['entries'] == 5)
+        assert(dsdb.get(("cache", 3))['value'] == 3)
+
+    def test_metadata_cache(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_meta", overwrite=True,
+                            use_write_thread=False, metadata_ttl=None)
+        key = ("meta", 1)
+        dsdb.save(key, value={'value': 1})
+        assert(dsdb.get(("meta", 2)) is None)
+
+        with mock.patch("os.stat", side_effect=AssertionError("stat")), \
+                mock.patch("os.path.exists", side_effect=AssertionError("exists")):
+            assert(dsdb.get(key)['value'] == 1)
+            assert(dsdb.get(("meta", 2)) is None)
+
+        dsdb.save(("meta", 2), value={'value': 2})
+        assert(dsdb.get(("meta", 2))['value'] == 2)
+
+        # the lookups are bounded like the entry cache, misses included
+        dsdb = DeadSimpleDB("/tmp/testdb_meta", use_write_thread=False, cache_max_entries=10)
+        for i in range(100):
+            assert(dsdb.get(("missing", i)) is None)
+        assert(len(dsdb.file_metadata) == 10)
+        assert(dsdb.get(key)['value'] == 1)
+
+        # without caching a get still resolves the file only once
+        dsdb = DeadSimpleDB("/tmp/testdb_meta", use_write_thread=False, metadata_ttl=0)
+        for get_key in [key, ("meta", 3)]:
+            with mock.patch.object(dsdb.storage, "stat", wraps=dsdb.storage.stat) as storage_stat:
+                dsdb.get(get_key)
+                dsdb.get(get_key)
+            assert(storage_stat.call_count == 2)
+
+    def test_reads_do_not_create_directories(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_dirs", overwrite=True, use_write_thread=False)
+        assert(dsdb.get(("missing", 1)) is None)
+        assert(dsdb.list(("missing", 1)) == ([], []))
+        assert(not os.path.exists("/tmp/testdb_dirs/missing"))
+
+        dsdb.save(("dirs", 1), name=0, value={'value': 0})
+        with mock.patch("os.makedirs", wraps=os.makedirs) as makedirs:
+            for i in range(1, 10):
+                dsdb.save(("dirs", 1), name=i, value={'value': i})
+            assert(makedirs.call_count == 0)
+
+        dsdb = DeadSimpleDB("/tmp/testdb_dirs_missing", read_only=True)
+        assert(dsdb.get(("missing", 1)) is None)
+        assert(not os.path.exists("/tmp/testdb_dirs_missing"))
+
+    def test_npy(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_npy", overwrite=True, use_write_thread=False)
+        key = ("arrays", 1)
+        arr = numpy.arange(5000, dtype=numpy.float32).reshape(50, 100)
+        dsdb.save(key, name="arr", value=arr, stype='npy')
+        dsdb.save(key, name="arrs", value={'a': arr, 'b': arr[0]}, stype='npz')
+        dsdb.save(key, name="json", value={'arr': numpy.arange(2000)})
+
+        dsdb = DeadSimpleDB("/tmp/testdb_npy", read_only=True)
+        mapped = dsdb.get(key, name="arr", mmap=True)
+        assert(isinstance(mapped, numpy.memmap))
+        assert(numpy.array_equal(mapped, arr))
+        arrs = dsdb.get(key, name="arrs")
+        assert(numpy.array_equal(arrs['b'], arr[0]))
+        assert(dsdb.get(key, name="json")['arr'].startswith("REDACTED"))
+
+    @unittest.skipUnless(OPTIONAL_CODECS, "orjson, msgpack, zstandard and lz4 required")
+    def test_serializers(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_serializers", overwrite=True,
+                            use_write_thread=False, json_backend="orjson")
+        key = ("serializers", 1)
+        value = {'value': 10, 'items': [1.5, 'abc', None], 'nested': {'a': numpy.int64(3)}}
+        stypes = ['json', 'pkl', 'msgpack', 'json.zst', 'json.lz4', 'msgpack.zst', 'pkl.lz4']
+        for stype in stypes:
+            dsdb.save(key, name=stype.replace(".", "_"), value=value, stype=stype)
+
+        dsdb = DeadSimpleDB("/tmp/testdb_serializers", read_only=True)
+        names, _ = dsdb.list(key)
+        assert(sorted(names) == sorted(stype.replace(".", "_") for stype in stypes))
+        for stype in stypes:
+            stored = dsdb.get(key, name=stype.replace(".", "_"), stype=stype)
+            assert(stored['items'] == value['items'])
+            assert(stored['nested']['a'] == 3)
+
+        # compressed variants are not probed for, they are read with stype
+        with mock.patch("os.path.exists", wraps=os.path.exists) as exists:
+            assert(dsdb.get(key, name="missing") is None)
+        probed = [call[0][0] for call in exists.call_args_list]
+        assert(probed and not any(path.endswith((".zst", ".lz4")) for path in probed))
+
+    def test_register_serializer(self):
+        from deadsimpledb.deadsimpledb import Serializer, register_serializer
+
+        class UpperSerializer(Serializer):
+            def dumps(self, value, options):
+                return value.upper().encode('utf-8')
+
+            def loads(self, data, options):
+                return data.decode('utf-8')
+
+        register_serializer('upper', UpperSerializer())
+        dsdb = DeadSimpleDB("/tmp/testdb_serializers_custom", overwrite=True, use_write_thread=False)
+        dsdb.save(("custom", 1), value="hello", stype="upper")
+        dsdb = DeadSimpleDB("/tmp/testdb_serializers_custom")
+        assert(dsdb.get(("custom", 1)) == "HELLO")
+
+    def test_get_many_save_many(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_many", overwrite=True, use_write_thread=False)
+        items = [(("many", 1), {'value': i}, i) for i in range(20)]
+        items.append((("many", 1), {'value': 'pickled'}, "pickled", "pkl"))
+        items.append((("many", 1), {'value': 'last'}, 0))
+        errors = dsdb.save_many(items)
+        assert(errors == [None] * len(items))
+
+        dsdb = DeadSimpleDB("/tmp/testdb_many", read_only=True)
+        requests = [(("many", 1), i) for i in range(20)]
+        requests += [(("many", 1), "pickled"), (("many", 1), "missing"), (("many", 1), "missing2", "pkl")]
+        results = dsdb.get_many(requests)
+        assert(results[0] == ({'value': 'last'}, None))
+        assert([value['value'] for value, _ in results[1:20]] == list(range(1, 20)))
+        assert(results[20] == ({'value': 'pickled'}, None))
+        assert(results[21] == (None, None))
+        assert(results[22] == (None, None))
+
+        with open("/tmp/testdb_many/many/1/broken.json", "w") as f:
+            f.write("{not json")
+        value, error = dsdb.get_many([(("many", 1), "broken")])[0]
+        assert(value is None and error is not None)
+        assert(len(dsdb.list_objects(("many", 1))) == 21)
+
+        # names another instance wrote after the key was listed are still found,
+        # even when the directory mtime did not change
+        path = "/tmp/testdb_many/many/1"
+        old = time.time() - 60
+        os.utime(path, (old, old))
+        dsdb.list(("many", 1))
+        DeadSimpleDB("/tmp/testdb_many", use_write_thread=False).save_many(
+            [(("many", 1), {'value': i}, "new{}".format(i)) for i in range(8)])
+        os.utime(path, (old, old))
+        results = dsdb.get_many([(("many", 1), "new{}".format(i)) for i in range(8)])
+        assert([value['value'] for value, _ in results] == list(range(8)))
+
+        # entries still queued for writing are served from the cache
+        dsdb = DeadSimpleDB("/tmp/testdb_many", max_write_latency=60)
+        for i in range(10):
+            dsdb.save(("queued", 1), name=i, value={'i': i})
+        results = dsdb.get_many([(("queued", 1), i) for i in range(10)])
+        assert([value['i'] for value, _ in results] == list(range(10)))
+        assert(len(dsdb.list_objects(("queued", 1))) == 10)
+        dsdb.close()
+
+    def test_async(self):
+        import asyncio
+        from deadsimpledb import AsyncDeadSimpleDB
+
+        async def run():
+            adb = AsyncDeadSimpleDB("/tmp/testdb_async", overwrite=True)
+            key = ("async", 1)
+            await adb.save(key, value={'value': 1})
+            await adb.flush_all()
+
+            reads = []
+            get = adb.db.get
+            def slow_get(*args, **kwargs):
+                reads.append(args)
+                time.sleep(0.05)
+                return get(*args, **kwargs)
+            adb.db.get = slow_get
+
+            values = await asyncio.gather(*[adb.get(key) for _ in range(10)])
+            assert(all(v['value'] == 1 for v in values))
+            assert(len(reads) == 1)
+            assert(await adb.list(("async",)) == ([], ['1']))
+            await adb.delete(key)
+            await adb.close()
+
+        asyncio.run(run())
+
+        async def run_bounded():
+            import threading
+            # a bounded queue may block, save must not run on the event loop
+            adb = AsyncDeadSimpleDB("/tmp/testdb_async", max_queue_items=1)
+            threads = []
+            save = adb.db.save
+            def recording_save(*args, **kwargs):
+                threads.append(threading.current_thread())
+                return save(*args, **kwargs)
+            adb.db.save = recording_save
+            for i in range(5):
+                await adb.save(("bounded", i), value={'value': i})
+            assert(threading.main_thread() not in threads)
+            await adb.close()
+
+        asyncio.run(run_bounded())
+
+    def test_flush_barrier(self):
+        dsdb = DeadSimpleDB("/tmp/testdb_flush", overwrite=True, max_write_latency=60)
+        key = ("flush", 1)
+        dsdb.save(key, name="a", value={'value': 1})
+        dsdb.save(key, name="b", value={'value': 2})
+
+        assert(dsdb.flush(key, name="a", timeout=5))
+        assert(os.path.exists("/tmp/testdb_flush/flush/1/a.json"))
+
+        start = time.time()
+        assert(dsdb.flush_all(timeout=5))
+        assert(os.path.exists("/tmp/testdb_flush/flush/1/b.json"))
+        assert(dsdb.write_queue.qsize() == 0)
+        dsdb.close()
+        assert(time.time() - start < 1)
+
+    def test_durability_modes(self):
+        for durability in ["none", "fsync", "group"]:
+            root = "/tmp/testdb_durability_{}".format(durability)
+            dsdb = DeadSimpleDB(root, overwrite=True, durability=durability,
+                                group_fsync_interval=1)
+            with mock.patch("shutil.copyfile", side_effect=AssertionError("copy")):
+                for i in range(20):
+                    dsdb.save(("durable", i), value={'value': i})
+                assert(dsdb.flush_all(timeout=10))
+            assert(not [f for f in os.listdir(root + "/durable/3") if "_tmp" in f or f.endswith(".tmp")])
+
+            sync_db = DeadSimpleDB(root, use_write_thread=False, durability=durability)
+            sync_db.save(("durable", "sync"), value={'value': 'sync'})
+
+            dsdb = DeadSimpleDB(root, read_only=True)
+            assert(dsdb.get(("durable", 19))['value'] == 19)
+            assert(dsdb.get(("durable", "sync"))['value'] == 'sync')
+
+    def test_packed_storage(self):
+        root = "/tmp/testdb_packed"
+        dsdb = DeadSimpleDB(root, overwrite=True, storage="packed")
+        for i in range(50):
+            dsdb.save(("packed", i), value={'value': i})
+        dsdb.save(("packed", "arr"), name="arr", value=numpy.arange(5), stype="npy")
+        for i in range(30):
+            dsdb.append_to_multipart_list("packed", name="log", value=i)
+        dsdb.delete(("packed", 7))
+        dsdb.flush_all()
+        assert(all(f.startswith("deadsimpledb.sqlite") for f in os.listdir(root)))
+
+        names, subkeys = dsdb.list("packed")
+        assert(len(subkeys) == 50 and "7" not in subkeys)
+        assert(list(dsdb.iter_multipart_list("packed", name="log")) == list(range(30)))
+
+        reader = DeadSimpleDB(root, read_only=True, storage="packed")
+        assert(reader.get(("packed", 3))['value'] == 3)
+        assert(reader.get(("packed", 7)) is None)
+        assert((reader.get(("packed", "arr"), name="arr") == numpy.arange(5)).all())
+
+        # synchronous is NORMAL (1) without durability, FULL (2) otherwise
+        assert(dsdb.storage.conn().execute("PRAGMA synchronous").fetchone()[0] == 1)
+        for durability in ["fsync", "group"]:
+            storage = DeadSimpleDB(root, storage="packed", durability=durability).storage
+            assert(storage.conn().execute("PRAGMA synchronous").fetchone()[0] == 2)
+            storage.close()
+
+        dsdb.export("/tmp/testdb_packed_export")
+        exported = DeadSimpleDB("/tmp/testdb_packed_export", read_only=True)
+        assert(exported.get(("packed", 49))['value'] == 49)
+        assert(list(exported.iter_multipart_list("packed", name="log")) == list(range(30)))
+        dsdb.close()
+        reader.close()
+
+    def test_key_index(self):
+        root = "/tmp/testdb_index"
+        dsdb = DeadSimpleDB(root, overwrite=True, use_write_thread=False)
+        for i in range(100):
+            dsdb.save(("index", "k{:03d}".format(i)), value={'value': i})
+        dsdb.save("index", name="meta", value={})
+
+        dsdb.list("index")
+        names, subkeys = dsdb.list("index", offset=10, limit=5)
+        assert(names == [] and subkeys == ["k010", "k011", "k012", "k013", "k014"])
+        assert(dsdb.list_keys("index", prefix="k05") == ["k05{}".format(i) for i in range(10)])
+        assert(dsdb.count("index") == (1, 100))
+        assert(dsdb.count("index", prefix="k09") == (0, 10))
+
+        # the index is used without rescans while the directory is unchanged
+        path = os.path.join(root, "index")
+        old = time.time() - 60
+        os.utime(path, (old, old))
+        dsdb.list("index")
+        with mock.patch("os.scandir", side_effect=AssertionError("rescan")):
+            assert(dsdb.count("index") == (1, 100))
+            assert(len(list(dsdb.list_keys_stream("index", page_size=7))) == 100)
+
+        dsdb.save(("index", "new"), value={})
+        dsdb.delete(("index", "k000"))
+        assert(dsdb.count("index") == (1, 100))
+        assert("new" in dsdb.list_keys("index") and "k000" not in dsdb.list_keys("index"))
+
+        # changes made by other processes show up once the mtime changed
+        os.utime(path, (old, old))
+        dsdb.list("index")
+        os.makedirs(os.path.join(path, "external"))
+        os.utime(path, (old + 1, old + 1))
+        assert("external" in dsdb.list_keys("index"))
+
+    def test_delete_many_and_prefix(self):
+        root = "/tmp/testdb_delete"
+        dsdb = DeadSimpleDB(root, overwrite=True, max_write_latency=60)
+        for i in range(20):
+            dsdb.save(("run", "a", i), value={'value': i})
+        dsdb.flush_all()
+        for i in range(20):
+            dsdb.save(("run", "b", i), value={'value': i})
+
+        # pending writes are dropped instead of being flushed first
+        dsdb.delete_many([(("run", "b", i), "data") for i in range(10)])
+        assert(dsdb.write_queue.qsize() == 10)
+        dsdb.delete_many([(("run", "a", i), "data") for i in range(10)])
+        assert(not os.path.exists(os.path.join(root, "run", "a", "3")))
+        assert(dsdb.get(("run", "b", 3)) is None)
+        assert(dsdb.list_keys(("run", "a")) == [str(i) for i in range(10, 20)])
+
+        dsdb.delete_prefix(("run",))
+        assert(dsdb.write_queue.qsize() == 0)
+        assert(not os.path.exists(os.path.join(root, "run")))
+        assert(dsdb.get(("run", "b", 15)) is None)
+        assert(dsdb.list("run") == ([], []))
+        assert(dsdb.cache_stats()['dirty'] == 0)
+
+        dsdb.save(("run", "a", 1), value={'value': 1})
+        dsdb.flush_all()
+        assert(dsdb.get(("run", "a", 1))['value'] == 1)
+        dsdb.close()
+
+    def test_snapshot_modes(self):
+        for snapshot in ["copy", "deepcopy", "serialize"]:
+            root = "/tmp/testdb_snapshot_{}".format(snapshot)
+            dsdb = DeadSimpleDB(root, overwrite=True, max_write_latency=60, snapshot=snapshot)
+            value = {'nested': {'values': [1, 2]}, 'arr': numpy.arange(3)}
+            dsdb.save("snap", value=value, stype="pkl")
+            # changes after save are not written until the next save
+            value['nested']['values'].append(3)
+            value['arr'][0] = 10
+            dsdb.flush_all()
+
+            stored = DeadSimpleDB(root, read_only=True).get("snap")
+            assert(stored['nested']['values'] == [1, 2])
+            assert(stored['arr'][0] == 0)
+            dsdb.close()
+
+        dsdb = DeadSimpleDB("/tmp/testdb_snapshot_error", overwrite=True, snapshot="serialize")
+        with self.assertRaises(Exception):
+            dsdb.save("snap", value=object(), stype="txt")
+        dsdb.close()
+
+    def test_stats(self):
+        events = []
+        dsdb = DeadSimpleDB("/tmp/testdb_stats", overwrite=True,
+                            hooks=[lambda event, seconds, info: events.append(event)])
+        dsdb.save("stats", value={'value': 1})
+        dsdb.flush_all()
+        dsdb.get("stats", refresh=True)
+        stats = dsdb.stats()
+        for event in ["flush", "queue_wait", "encode", "write", "read", "get"]:
+            assert(stats['latency'][event]['count'] == 1)
+            assert(event in events)
+        assert(stats['counters']['bytes_written.json'] > 0)
+        assert(stats['queue_depth'] == 0)
+
+        with self.assertLogs(level="ERROR"):
+            dsdb.save("stats", name="bad", value=object(), stype="txt")
+            dsdb.flush_all()
+        assert(dsdb.stats()['counters']['write_errors'] == 1)
+        dsdb.close()
+
+        dsdb = DeadSimpleDB("/tmp/testdb_stats", use_write_thread=False)
+        dsdb.get("stats")
+        assert(dsdb.metrics is None and dsdb.stats()['latency'] == {})
+
+    def test_multi_process(self):
+        import multiprocessing
+        root = "/tmp/testdb_multi_process"
+        DeadSimpleDB(root, overwrite=True).close()
+
+        workers = 4
+        count = 25
+        ctx = multiprocessing.get_context("fork")
+        procs = [ctx.Process(target=multi_process_worker, args=(root, w, count)) for w in range(workers)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            assert(p.exitcode == 0)
+
+        dsdb = DeadSimpleDB(root, read_only=True)
+        assert(sorted(dsdb.get("shared", name="list")) == list(range(workers * count)))
+        assert(len(dsdb.get("shared", name="dict")) == workers * count)
+        assert(sorted(dsdb.iter_multipart_list("shared", name="log")) == list(range(workers * count)))
+        assert(dsdb.get("shared", name="plain")['worker'] in range(workers))
+        assert(dsdb.list("shared")[1] == [])
+        assert(".locks" not in dsdb.list([])[1])
+
+    def test_dict_delta_log(self):
+        root = "/tmp/testdb_delta"
+        path = os.path.join(root, "state")
+        state = {"field_{}".format(i): "x" * 100 for i in range(1000)}
+        dsdb = DeadSimpleDB(root, overwrite=True, use_write_thread=False,
+                            dict_delta_log=True, dict_delta_compact_bytes=2000)
+        dsdb.save("state", value=state)
+        base_mtime = os.path.getmtime(os.path.join(path, "data.json"))
+
+        dsdb.update_dict("state", {"step": 1})
+        dsdb.remove_items_from_dict("state", ["field_0"])
+        # only the patch log was written
+        assert(os.path.getmtime(os.path.join(path, "data.json")) == base_mtime)
+        assert(os.path.getsize(os.path.join(path, "data__delta.jsonl")) < 100)
+        reader = DeadSimpleDB(root, read_only=True, dict_delta_log=True)
+        value = reader.get("state")
+        assert(value["step"] == 1 and "field_0" not in value and len(value) == 1000)
+        # the cached value of another instance is refreshed by new patches
+        dsdb.update_dict("state", {"step": 2})
+        assert(reader.get("state")["step"] == 2)
+
+        # past the threshold the patches are merged into the json file
+        for i in range(100):
+            dsdb.update_dict("state", {"step": i})
+        assert(DeadSimpleDB(root, read_only=True).get("state")["step"] > 1)
+        value = DeadSimpleDB(root, read_only=True, dict_delta_log=True).get("state")
+        assert(value["step"] == 99 and "field_0" not in value)
+        assert(not os.path.exists(os.path.join(path, "data__delta_compacting.jsonl")))
+
+        # a full save replaces the patches
+        dsdb.update_dict("state", {"step": 100})
+        dsdb.save("state", value={"fresh": True})
+        assert(DeadSimpleDB(root, read_only=True, dict_delta_log=True).get("state") == {"fresh": True})
+        dsdb.update_dict("state", {"b": 2})
+        dsdb.save_many([("state", {"fresh": False})])
+        assert(DeadSimpleDB(root, read_only=True, dict_delta_log=True).get("state") == {"fresh": False})
+        dsdb.update_dict("state", {"b": 2})
+        locked = DeadSimpleDB(root, use_write_thread=False, multi_process=True, dict_delta_log=True)
+        locked.update_dict("state", {"c": 3})
+        locked.remove_items_from_dict("state", ["b"])
+        locked.close()
+        assert(not os.path.exists(os.path.join(path, "data__delta.jsonl")))
+        assert(DeadSimpleDB(root, read_only=True, dict_delta_log=True).get("state") == {"fresh": False, "c": 3})
+
+    def test_dict_delta_log_background(self):
+        root = "/tmp/testdb_delta_background"
+        dsdb = DeadSimpleDB(root, overwrite=True, dict_delta_log=True, dict_delta_compact_bytes=500,
+                            snapshot="copy")
+        dsdb.save("state", value={"base": 1})
+        for i in range(300):
+            dsdb.update_dict("state", {"step": i, "field_{}".format(i % 10): i})
+        dsdb.close()
+        value = DeadSimpleDB(root, read_only=True, dict_delta_log=True).get("state")
+        assert(value["step"] == 299 and value["base"] == 1 and value["field_9"] == 299)
+
+        # a save made while the compacted value is being written wins
+        import threading
+        dsdb = DeadSimpleDB(root, overwrite=True, dict_delta_log=True, dict_delta_compact_bytes=100,
+                            max_write_latency=0)
+        dsdb.save("state", value={"old": 1})
+        dsdb.flush_all()
+        compacting = threading.Event()
+        write = dsdb._write
+        def slow_write(key, value, name='data', stype="json"):
+            if threading.current_thread().name.startswith("ThreadPoolExecutor"):
+                compacting.set()
+                time.sleep(0.5)
+            return write(key, value, name, stype)
+        dsdb._write = slow_write
+        dsdb.update_dict("state", {"x": "y" * 200})
+        assert(compacting.wait(5))
+        dsdb.save("state", value={"new": True})
+        dsdb.close()
+        assert(DeadSimpleDB(root, read_only=True, dict_delta_log=True).get("state") == {"new": True})
+
+
+    def test_images(self):
+        root = "/tmp/testdb_images"
+        image = numpy.random.RandomState(0).randint(0, 255, (64, 96, 3)).astype(numpy.uint8)
+        for storage in ["files", "packed"]:
+            dsdb = DeadSimpleDB(root, overwrite=True, storage=storage, encode_processes=1,
+                                png_compress_level=1, jpg_quality=90)
+            dsdb.save("img", name="lossless", value=image, stype="png")
+            dsdb.save("img", name="photo", value=image, stype="jpg")
+            dsdb.close()
+
+            reader = DeadSimpleDB(root, read_only=True, storage=storage)
+            png = reader.get("img", name="lossless")
+            assert(png.shape == (64, 96, 3) and png.size == (96, 64))
+            assert(png._array is None)
+            assert((numpy.asarray(png) == image).all())
+            jpg = reader.get("img", name="photo")
+            assert(jpg.to_array(draft_size=(24, 16)).shape == (16, 24, 3))
+            assert(numpy.asarray(jpg).shape == (64, 96, 3))
+            reader.close()
+
+        # an image read before the entry is rewritten or deleted keeps its pixels
+        dsdb = DeadSimpleDB(root, overwrite=True, use_write_thread=False)
+        dsdb.save("img", value=numpy.zeros((8, 8), dtype=numpy.uint8), stype="png")
+        old = DeadSimpleDB(root, read_only=True).get("img", stype="png")
+        dsdb.save("img", value=numpy.ones((4, 4), dtype=numpy.uint8), stype="png")
+        dsdb.delete("img")
+        assert(old.shape == (8, 8) and (numpy.asarray(old) == 0).all())
+
+    def test_csv_rows(self):
+        root = "/tmp/testdb_rows"
+        dsdb = DeadSimpleDB(root, overwrite=True, row_index_step=10)
+        dsdb.save("table", value=[["row", 0], ["row", 1]], stype="csv")
+        for i in range(2, 100, 7):
+            dsdb.append_rows("table", [["row", j] for j in range(i, min(i + 7, 100))])
+        dsdb.append_rows("table", [["multi\nline|quoted", 100]])
+
+        rows = list(dsdb.iter_rows("table"))
+        assert(len(rows) == 101 and rows[57] == ["row", "57"])
+        assert(rows[100] == ["multi\nline|quoted", "100"])
+        assert(list(dsdb.iter_rows("table", start=43, stop=46)) == [["row", str(i)] for i in range(43, 46)])
+        assert(dsdb.get("table", stype="csv")[99] == ["row", "99"])
+        dsdb.close()
+
+        # the index is reloaded from its sidecar and rebuilt for rows it has not seen
+        with open(os.path.join(root, "table", "data.csv"), "a") as f:
+            f.write("row\t101\r\n")
+        reader = DeadSimpleDB(root, read_only=True, row_index_step=10)
+        assert(list(reader.iter_rows("table", start=100)) == [["multi\nline|quoted", "100"], ["row", "101"]])
+        assert(reader._get_row_index(("table",), "data")['rows'] == 102)
+
+        # saving the whole table again drops the index
+        dsdb = DeadSimpleDB(root, row_index_step=10)
+        dsdb.save("table", value=[["new", i] for i in range(30)], stype="csv")
+        assert(list(dsdb.iter_rows("table", start=25, stop=27)) == [["new", "25"], ["new", "26"]])
+        dsdb.close()
+
+        # so does any other write of the entry
+        dsdb = DeadSimpleDB(root, use_write_thread=False, row_index_step=10)
+        assert(list(dsdb.iter_rows("table", start=25, stop=26)) == [["new", "25"]])
+        dsdb.save_many([("table", [["longer row", i] for i in range(40)], "data", "csv")])
+        assert(list(dsdb.iter_rows("table", start=25, stop=26)) == [["longer row", "25"]])
+
+        # a file of the same size written by someone else is not trusted either
+        path = os.path.join(root, "table", "data.csv")
+        with open(path, newline="") as f:
+            content = f.read()
+        with open(path, "w", newline="") as f:
+            f.write(content.replace("longer row\t0\r\n", "a\t0\r\nbbbbbbb\r\n"))
+        os.utime(path, (1, 1))
+        assert(list(dsdb.iter_rows("table", start=25, stop=26)) == [["longer row", "24"]])
+        assert(dsdb._get_row_index(("table",), "data")['rows'] == 41)
+
+    def test_bounded_queue(self):
+        root = "/tmp/testdb_bounded_queue"
+        dsdb = DeadSimpleDB(root, overwrite=True, max_write_latency=10,
+                            max_queue_items=4, queue_overflow="sync")
+        for i in range(20):
+            dsdb.save(("bounded", i), value={'i': i})
+        assert(dsdb.queue_depth() <= 4)
+        assert(dsdb.stats()['queue']['sync_writes'] > 0)
+        # entries already queued are replaced, not counted again
+        for i in range(10):
+            dsdb.save(("bounded", 0), value={'i': i})
+        dsdb.close()
+
+        dsdb = DeadSimpleDB(root, max_write_latency=10, max_queue_bytes=1000)
+        for i in range(20):
+            dsdb.save(("blocking", i), value={'i': i, 'pad': "x" * 50})
+            assert(dsdb.write_queue.nbytes() <= 1000)
+        assert(dsdb.stats()['queue']['blocked'] > 0)
+        dsdb.close()
+
+        # the byte bound counts what the values hold, not just their top level
+        dsdb = DeadSimpleDB(root, max_write_latency=10, max_queue_bytes=100000, queue_overflow="sync")
+        for i in range(10):
+            dsdb.save(("large", i), value={'rows': [["x" * 100] * 10 for _ in range(1000)]})
+        assert(dsdb.stats()['queue']['sync_writes'] == 9)
+        dsdb.close()
+
+        reader = DeadSimpleDB(root, read_only=True)
+        assert(reader.get(("bounded", 0)) == {'i': 9})
+        assert([reader.get(("bounded", i))['i'] for i in range(20)][1:] == list(range(1, 20)))
+        assert(reader.get(("blocking", 19))['i'] == 19)
+
+    def test_lazy_startup(self):
+        import subprocess
+        import sys
+        root = "/tmp/testdb_lazy_startup"
+        dsdb = DeadSimpleDB(root, overwrite=True)
+        dsdb.save("entry", value={'a': 1})
+        dsdb.save("array", value=numpy.arange(3), stype="npy")
+        dsdb.close()
+
+        # heavy imports and the writer threads wait until they are needed
+        code = "\n".join([
+            "import sys, threading",
+            "import deadsimpledb",
+            "db = deadsimpledb.DeadSimpleDB({!r})".format(root),
+            "heavy = ['numpy', 'PIL', 'simplejson', 'asyncio', 'multiprocessing']",
+            "assert not [m for m in heavy if m in sys.modules], sys.modules.keys()",
+            "assert threading.active_count() == 1",
+            "assert db.get('entry') == {'a': 1}",
+            "assert 'numpy' not in sys.modules",
+            "db.save('other', value=[1])",
+            "assert threading.active_count() == 2",
+            "assert db.get('array', stype='npy').tolist() == [0, 1, 2]",
+            "from deadsimpledb.deadsimpledb import JSONEncoderDefault",
+            "db.close()"])
+        project = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, "-c", code], cwd=project,
+                                capture_output=True, text=True)
+        assert(result.returncode == 0), result.stderr
+        assert(result.stdout == "")
+
+    def test_write_at_exit(self):
+        import subprocess
+        import sys
+        root = "/tmp/testdb_exit"
+        # queued writes of a script that never calls close are written at exit
+        code = "\n".join([
+            "import deadsimpledb",
+            "db = deadsimpledb.DeadSimpleDB({!r}, overwrite=True, max_write_latency=60)".format(root),
+            "db.save('entry', value={'a': 1})"])
+        project = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, "-c", code], cwd=project,
+                                capture_output=True, text=True)
+        assert(result.returncode == 0), result.stderr
+        assert(DeadSimpleDB(root, read_only=True).get("entry") == {'a': 1})
+
+        # the encode pool is already shut down when the exit hook runs
+        code = "\n".join([
+            "import deadsimpledb, numpy",
+            "db = deadsimpledb.DeadSimpleDB({!r}, overwrite=True, max_write_latency=60,".format(root),
+            "                               encode_processes=1)",
+            "db.save('image', value=numpy.ones((4, 4), dtype=numpy.uint8), stype='png')",
+            "db.save('array', value=numpy.ones(3), stype='pkl')"])
+        result = subprocess.run([sys.executable, "-c", code], cwd=project,
+                                capture_output=True, text=True)
+        assert(result.returncode == 0), result.stderr
+        assert(result.stderr == ""), result.stderr
+        dsdb = DeadSimpleDB(root, read_only=True)
+        assert(numpy.asarray(dsdb.get("image"))[0, 0] == 1)
+        assert(list(dsdb.get("array")) == [1, 1, 1])
+
+    def test_update_after_eviction(self):
+        root = "/tmp/testdb_update_eviction"
+        for use_write_thread in [False, True]:
+            dsdb = DeadSimpleDB(root, overwrite=True, use_write_thread=use_write_thread,
+                                cache_max_bytes=100)
+            dsdb.save("k", value={'a': "x" * 1000})
+            dsdb.save("l", value=["x" * 1000])
+            dsdb.flush_all()
+            dsdb.update_dict("k", {'b': 1})
+            dsdb.remove_items_from_dict("k", ["a"])
+            dsdb.append_to_list("l", 2)
+            dsdb.close()
+            reader = DeadSimpleDB(root, read_only=True)
+            assert(reader.get("k") == {'b': 1})
+            assert(reader.get("l") == ["x" * 1000, 2])
+
+def multi_process_worker(root, worker, count):
+    dsdb = DeadSimpleDB(root, multi_process=True, multipart_segment_bytes=64)
+    # writes on the calling thread so a failed write fails the worker
+    sync_db = DeadSimpleDB(root, multi_process=True, use_write_thread=False)
+    for i in range(worker * count, (worker + 1) * count):
+        dsdb.append_to_list("shared", i, name="list")
+        dsdb.update_dict("shared", {str(i): i}, name="dict")
+        dsdb.append_to_multipart_list("shared", i, name="log")
+        for _ in range(10):
+            sync_db.save("shared", {'worker': worker, 'i': i}, name="plain")
+    dsdb.close()